@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from actions.inventory_monitoring import (
+    InventoryEventEnum,
+    InventoryMonitor,
+    MonitorTask,
+    apple_api_host,
+    poll_seconds,
+)
+from common.schemas import InventoryEventSchema
+from libs.async_requests import AsyncRequest
+from libs.coordination import ClusterCoordinator
+from libs.history import HistoryWriter
+from libs.notifications import AsyncNotificationDispatcher
+from libs.planner import RestockPlanner
+from libs.scheduler import PollScheduler, AdaptiveScheduler, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncInventoryMonitor(InventoryMonitor):
+    """
+    Every target polls in its own task of one event loop instead of a worker thread,
+    notifications are pushed on the same loop. The checkout steps and the cluster
+    calls still block, they are handed to threads.
+    """
+
+    notifier_class = AsyncNotificationDispatcher
+
+    def __init__(
+        self,
+        max_workers: int = 100,
+        scheduler_class: type[PollScheduler] = AdaptiveScheduler,
+        host: str = apple_api_host,
+        order_host: Optional[str] = None,
+        cluster: Optional[ClusterCoordinator] = None,
+        history: Optional[HistoryWriter] = None,
+        planner: Optional[RestockPlanner] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        super().__init__(
+            max_workers=max_workers,
+            scheduler_class=scheduler_class,
+            host=host,
+            order_host=order_host,
+            cluster=cluster,
+            history=history,
+            planner=planner,
+            rate_limiter=rate_limiter,
+        )
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stop_event: Optional[asyncio.Event] = None
+
+    def new_session(self, host: str) -> AsyncRequest:
+        return AsyncRequest(host, pool_size=self.max_workers)
+
+    def run(self, tasks: list[MonitorTask]):
+        asyncio.run(self.run_async(tasks))
+
+    async def run_async(self, tasks: list[MonitorTask]):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.notifier.bind(self.loop)
+        try:
+            await self.session.warm(count=min(len(tasks), self.max_workers))
+            await asyncio.gather(*(self.run_target(i) for i in tasks))
+            # deliver the remaining notifications while the loop still runs
+            await self.notifier.join_async()
+        finally:
+            await self.session.close()
+            for provider in self.notification_providers:
+                await provider.close_async()
+
+    async def run_target(self, task: MonitorTask):
+        while not self.is_stop:
+            await self.run_task_async(task)
+            try:
+                await asyncio.wait_for(
+                    self.stop_event.wait(), timeout=max(task.next_run - time.time(), 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_task_async(self, task: MonitorTask):
+        try:
+            # the cluster store is SQLite
+            if await asyncio.to_thread(self.is_owned, task):
+                await self.poll_async(task)
+                self.poll_succeeded(task)
+        except Exception as e:
+            self.poll_failed(task, e)
+        finally:
+            task.next_run = time.time() + task.scheduler.next_delay()
+
+    async def poll_async(self, task: MonitorTask):
+        shop_data = task.shop_data
+        if self.rate_limiter:
+            await asyncio.sleep(self.rate_limiter.reserve())
+        inventory_data = await self.get_data_async(
+            shop_data.country,
+            shop_data.models,
+            shop_data.location,
+            shop_data.postal_code,
+            shop_data.state,
+        )
+        events = self.update_snapshot(task, inventory_data)
+        if events:
+            await self.handle_events_async(task, events)
+
+    async def handle_events_async(
+        self, task: MonitorTask, events: list[InventoryEventSchema]
+    ):
+        # claiming the notifications of a cluster blocks
+        await asyncio.to_thread(self.notify_events, task, events)
+        if not self.order_dispatcher:
+            return
+        self.order_dispatcher.discard(
+            [i for i in events if i.type == InventoryEventEnum.UNAVAILABLE]
+        )
+        succeeded, retry_events = await self.order_dispatcher.dispatch_async(
+            [i for i in events if i.type == InventoryEventEnum.AVAILABLE]
+        )
+        self.handle_order_results(task, succeeded, retry_events)
+
+    async def get_data_async(
+        self,
+        country: str,
+        models: list[str],
+        location: str = "",
+        postal_code: str = "",
+        state: str = "",
+    ):
+        search_params = self.get_search_params(models, location, postal_code, state)
+        with poll_seconds.time(country=country):
+            resp = await self.session.get(
+                f"/{country}/shop/fulfillment-messages",
+                params=search_params,
+                hedge=True,
+            )
+        resp.raise_for_status()
+
+        return resp.json()
+
+    def stop(self):
+        super().stop()
+        # stop() may be called from any thread, the event belongs to the loop
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
@@ -0,0 +1,239 @@
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import time
+from enum import Enum
+from typing import Iterator, Optional, TYPE_CHECKING
+
+from common.schemas import OrderSchema
+from libs.metrics import registry
+
+if TYPE_CHECKING:
+    from actions.order import Order, OrderRace
+
+logger = logging.getLogger(__name__)
+
+step_seconds = registry.histogram(
+    "apple_checkout_step_seconds", "Duration of checkout steps", ("step", "result")
+)
+
+
+class CheckoutStepEnum(str, Enum):
+    SELECT_WINDOW = "select_window"
+    FILL_CONTACT = "fill_contact"
+    FILL_RECIPIENT = "fill_recipient"
+    FILL_PAY_METHOD = "fill_pay_method"
+    PLACE_ORDER = "place_order"
+    PROCESS_ORDER = "process_order"
+    CONFIRM_ORDER = "confirm_order"
+
+
+# seconds, polling steps give up after their deadline, the others only warn
+default_deadlines = {
+    CheckoutStepEnum.SELECT_WINDOW: 15,
+    CheckoutStepEnum.FILL_CONTACT: 15,
+    CheckoutStepEnum.FILL_RECIPIENT: 15,
+    CheckoutStepEnum.FILL_PAY_METHOD: 15,
+    CheckoutStepEnum.PLACE_ORDER: 30,
+    CheckoutStepEnum.PROCESS_ORDER: 60,
+    CheckoutStepEnum.CONFIRM_ORDER: 120,
+}
+
+
+@dataclasses.dataclass()
+class CheckoutStepRecord(object):
+    step: str
+    started_at: float
+    duration: float
+    success: bool
+
+
+class CheckoutStateMachine(object):
+    """
+    The checkout chain from choosing the time slot to the order number, one step at a time.
+    Every step is timed and bounded by its deadline. Once the order is placed, a failed
+    step resumes on the same session, the order is never placed twice.
+    """
+
+    steps = list(CheckoutStepEnum)
+    place_order_idx = steps.index(CheckoutStepEnum.PLACE_ORDER)
+
+    def __init__(
+        self,
+        order: "Order",
+        order_data: OrderSchema,
+        race: Optional["OrderRace"] = None,
+        deadlines: Optional[dict[CheckoutStepEnum, float]] = None,
+        max_resumes: int = 2,
+    ) -> None:
+        super().__init__()
+        self.order = order
+        self.order_data = order_data
+        self.race = race
+        self.deadlines = default_deadlines | (deadlines or {})
+        self.max_resumes = max_resumes
+        self.resumes = 0
+        self.step_idx = 0
+        self.claimed = False
+        self.records: list[CheckoutStepRecord] = []
+
+        self.selected_window: Optional[dict] = None
+        self.place_order_data: Optional[dict] = None
+        self.order_number = ""
+
+    @property
+    def step(self) -> Optional[CheckoutStepEnum]:
+        return self.steps[self.step_idx] if self.step_idx < len(self.steps) else None
+
+    def run(self) -> Optional[bool]:
+        """
+        True when the order is placed, False without time slots, None when the race is lost.
+        A step failing after the order is placed is resumed, when it keeps failing
+        the order still counts as placed.
+        """
+        self.claimed = False
+        while self.step:
+            step = self.step
+            if not self.keep_racing():
+                return None
+            try:
+                with self.record_step(step) as record:
+                    record.success = (
+                        getattr(self, step.value)(self.deadlines[step]) is not False
+                    )
+            except Exception as e:
+                if not self.is_placed():
+                    raise
+                if self.can_resume(step, e):
+                    continue
+                return True
+            if not record.success:
+                return False
+            self.step_idx += 1
+
+        logger.info(f"Checkout timings: {self.intro_records()}")
+        return True
+
+    async def run_async(self) -> Optional[bool]:
+        """run on an event loop, the blocking steps are handed to threads one at a time"""
+        self.claimed = False
+        while self.step:
+            step = self.step
+            # renewing the order lease blocks
+            if not await asyncio.to_thread(self.keep_racing):
+                return None
+            try:
+                with self.record_step(step) as record:
+                    result = await asyncio.to_thread(
+                        getattr(self, step.value), self.deadlines[step]
+                    )
+                    record.success = result is not False
+            except Exception as e:
+                if not self.is_placed():
+                    raise
+                if self.can_resume(step, e):
+                    continue
+                return True
+            if not record.success:
+                return False
+            self.step_idx += 1
+
+        logger.info(f"Checkout timings: {self.intro_records()}")
+        return True
+
+    def is_placed(self) -> bool:
+        return self.step_idx > self.place_order_idx
+
+    def can_resume(self, step: CheckoutStepEnum, e: Exception) -> bool:
+        """Whether the step failing after the order is placed is tried again"""
+        self.resumes += 1
+        if self.resumes <= self.max_resumes:
+            logger.warning(
+                f"Checkout step {step.value} failed after placing the order, resume: {e}"
+            )
+            return True
+        logger.error(
+            f"The order is placed but {step.value} keeps failing, check the account: {e}"
+        )
+        return False
+
+    def keep_racing(self) -> bool:
+        """False once another store of the race wins or another node leases the order"""
+        if not self.race:
+            return True
+        if self.race.renew and not self.race.renew() and not self.is_placed():
+            logger.warning("The order lease is held by another node, give up")
+            return False
+        if self.step == CheckoutStepEnum.FILL_CONTACT:
+            if self.race.is_lost(self.order_data.store_number):
+                return False
+        # only one attempt of the race may place the order
+        if self.step_idx >= self.place_order_idx and not self.claimed:
+            if not self.race.claim(self.order_data.store_number):
+                logger.info(f"Store {self.race.winner} won the order race, give up")
+                return False
+            self.claimed = True
+        return True
+
+    @contextlib.contextmanager
+    def record_step(self, step: CheckoutStepEnum) -> Iterator[CheckoutStepRecord]:
+        record = CheckoutStepRecord(step.value, time.time(), 0, False)
+        try:
+            yield record
+        finally:
+            record.duration = time.time() - record.started_at
+            step_seconds.observe(
+                record.duration,
+                step=step.value,
+                result="success" if record.success else "failure",
+            )
+            self.records.append(record)
+            deadline = self.deadlines[step]
+            if record.duration > deadline:
+                logger.warning(
+                    f"Checkout step {step.value} took {record.duration:.2f}s, over {deadline}s"
+                )
+
+    def intro_records(self) -> str:
+        return ", ".join(f"{i.step} {i.duration:.3f}s" for i in self.records)
+
+    def select_window(self, timeout: float):
+        self.selected_window = self.order.select_window(self.order_data)
+        return bool(self.selected_window)
+
+    def fill_contact(self, timeout: float):
+        self.order.fill_contact(
+            self.selected_window,
+            self.order_data.store_number,
+            self.order_data.country,
+            self.order_data.state,
+            self.order_data.city,
+            self.order_data.district,
+        )
+
+    def fill_recipient(self, timeout: float):
+        delivery = self.order_data.delivery
+        self.order.fill_recipient(
+            delivery.first_name,
+            delivery.last_name,
+            delivery.email,
+            delivery.phone,
+            delivery.idcard,
+        )
+
+    def fill_pay_method(self, timeout: float):
+        delivery = self.order_data.delivery
+        self.order.fill_pay_method(delivery.payment, delivery.payment_number)
+
+    def place_order(self, timeout: float):
+        logger.info("Starting final checkout...")
+        self.place_order_data = self.order.get_place_order_data(timeout=timeout)
+
+    def process_order(self, timeout: float):
+        self.order.process_order(self.place_order_data, timeout=timeout)
+
+    def confirm_order(self, timeout: float):
+        self.order_number = self.order.get_order_number(
+            self.place_order_data, timeout=timeout
+        )
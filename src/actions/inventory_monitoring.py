@@ -1,16 +1,49 @@
+import dataclasses
+import heapq
+import itertools
 import logging
+import queue
+import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Optional
+from typing import Optional, Union, Iterable, Iterator
 
-from actions.order import OrderSessionPool
-from common.schemas import DeliverySchema, ShopSchema, OrderSchema, OrderDeliverySchema
-from libs.notifications import NotificationBase
+from actions.order_dispatcher import OrderDispatcher
+from common.schemas import (
+    DeliverySchema,
+    ShopSchema,
+    OrderDeliverySchema,
+    InventoryEventSchema,
+    WishSchema,
+)
+from libs.coordination import ClusterCoordinator
+from libs.history import HistoryWriter
+from libs.planner import PlannedScheduler, RestockPlanner
+from libs.metrics import registry
+from libs.notifications import NotificationBase, NotificationDispatcher
 from libs.requests import Request
+from libs.scheduler import PollScheduler, AdaptiveScheduler, RateLimiter
 
 logger = logging.getLogger(__name__)
 
+poll_seconds = registry.histogram(
+    "apple_monitor_poll_seconds",
+    "Latency of fulfillment-messages queries",
+    ("country",),
+)
+parse_seconds = registry.histogram(
+    "apple_monitor_parse_seconds",
+    "Time to parse a fulfillment-messages payload",
+)
+poll_total = registry.counter(
+    "apple_monitor_polls_total", "Inventory queries by result", ("country", "result")
+)
+events_total = registry.counter(
+    "apple_monitor_events_total", "Inventory events by type", ("type",)
+)
+
 apple_api_host = "https://www.apple.com"
 
 
@@ -19,140 +52,386 @@ class DeliveryStatusEnum(str, Enum):
     INELIGIBLE = "ineligible"
 
 
-class InventoryMonitor(object):
+class InventoryEventEnum(str, Enum):
+    AVAILABLE = "available"
+    UNAVAILABLE = "unavailable"
+    QUOTE_CHANGED = "quote_changed"
+
+
+def compile_store_filters(store_filters: Optional[list[str]]) -> Optional[re.Pattern]:
+    """Match a store name containing any of the filters with one scan"""
+    if not store_filters:
+        return None
+    return re.compile("|".join(re.escape(i) for i in store_filters))
+
+
+class InventorySnapshot(object):
+    """Previous query result keyed by (store_number, part number), turned into transition events"""
+
     def __init__(self) -> None:
         super().__init__()
-        self.session = Request(apple_api_host)
+        self.deliveries: dict[tuple[str, str], DeliverySchema] = {}
+        self.initialized = False
+
+    def update(
+        self, deliveries: Iterable[DeliverySchema]
+    ) -> list[InventoryEventSchema]:
+        current = {(i.store_number, i.model): i for i in deliveries}
+        events = []
+        for key, delivery in current.items():
+            previous = self.deliveries.get(key)
+            is_available = delivery.status == DeliveryStatusEnum.AVAILABLE
+            was_available = (
+                previous is not None and previous.status == DeliveryStatusEnum.AVAILABLE
+            )
+            if is_available and not was_available:
+                event_type = InventoryEventEnum.AVAILABLE
+            elif was_available and not is_available:
+                event_type = InventoryEventEnum.UNAVAILABLE
+            elif is_available and previous.pickup_quote != delivery.pickup_quote:
+                event_type = InventoryEventEnum.QUOTE_CHANGED
+            else:
+                continue
+            events.append(InventoryEventSchema(event_type.value, delivery, previous))
+
+        # stores missing from the response are no longer available
+        for key, previous in self.deliveries.items():
+            if key not in current and previous.status == DeliveryStatusEnum.AVAILABLE:
+                events.append(
+                    InventoryEventSchema(
+                        InventoryEventEnum.UNAVAILABLE.value, previous, previous
+                    )
+                )
+
+        self.deliveries = current
+        self.initialized = True
+        return events
+
+    def forget(self, key: tuple[str, str]):
+        self.deliveries.pop(key, None)
+
+    def apply(self, events: list[InventoryEventSchema]):
+        """Follow the events of a snapshot kept elsewhere"""
+        for event in events:
+            if event.type == InventoryEventEnum.UNAVAILABLE:
+                self.deliveries.pop(event.key(), None)
+            else:
+                self.deliveries[event.key()] = event.delivery
+
+    def seed(self, deliveries: Iterable[DeliverySchema]):
+        """Start from the stock already known, only the changes since emit events"""
+        self.deliveries = {(i.store_number, i.model): i for i in deliveries}
+
+    def has_available(self) -> bool:
+        return any(
+            i.status == DeliveryStatusEnum.AVAILABLE for i in self.deliveries.values()
+        )
+
+
+@dataclasses.dataclass()
+class MonitorTask(object):
+    shop_data: ShopSchema
+    scheduler: PollScheduler
+    store_pattern: Optional[re.Pattern] = None
+    snapshot: InventorySnapshot = dataclasses.field(default_factory=InventorySnapshot)
+    next_run: float = 0
+
+
+class InventoryMonitor(object):
+    notifier_class: type[NotificationDispatcher] = NotificationDispatcher
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        scheduler_class: type[PollScheduler] = AdaptiveScheduler,
+        host: str = apple_api_host,
+        order_host: Optional[str] = None,
+        cluster: Optional[ClusterCoordinator] = None,
+        history: Optional[HistoryWriter] = None,
+        planner: Optional[RestockPlanner] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        super().__init__()
+        self.max_workers = max_workers
+        self.scheduler_class = scheduler_class
+        # all targets share one session, so the pool must fit every worker
+        self.session = self.new_session(host)
+        # None means the order default of the country
+        self.order_host = order_host
+        # other nodes poll the targets they own, see libs.coordination
+        self.cluster = cluster
+        self.history = history
+        # the intervals follow the restock history, the limiter caps them all
+        self.planner = planner
+        self.rate_limiter = rate_limiter
         self.is_stop = False
-        self.order_pool: Optional[OrderSessionPool] = None
+        self.order_dispatcher: Optional[OrderDispatcher] = None
+        self.notification_providers: list[NotificationBase] = []
+        self.order_notice_count = 1
+        self.notifier = self.notifier_class()
+        self.done_tasks: queue.Queue[Optional[MonitorTask]] = queue.Queue()
+
+    def new_session(self, host: str) -> Request:
+        return Request(host, pool_size=self.max_workers)
 
     def start(
         self,
-        shop_data: ShopSchema,
+        shop_data: Union[ShopSchema, list[ShopSchema]],
         order: bool = False,
         delivery_data: Optional[OrderDeliverySchema] = None,
         notification_providers: Optional[list[NotificationBase]] = None,
         interval: int = 5,
         order_notice_count: int = 1,
         ac_type : str = "",
-        ac_model : str = ""
+        ac_model : str = "",
+        order_stage_interval: int = 0,
+        order_race_count: int = 1,
+        wishes: Optional[list[WishSchema]] = None,
+        buyers: Optional[dict[str, OrderDeliverySchema]] = None,
     ):
-        logger.info(f"Start monitoring, query interval: {interval}s")
-        order_data: Optional[OrderSchema] = None
+        targets = shop_data if isinstance(shop_data, list) else [shop_data]
+        assert targets, "At least one monitoring target is required"
+        logger.info(
+            f"Start monitoring {len(targets)} target(s), query interval: {interval}s"
+        )
+        self.notification_providers = notification_providers or []
+        self.order_notice_count = order_notice_count
+        self.history and self.history.start()
         if order:
-            # only support one product
-            # fixme Is there a better way to obtain the model code?
-            order_data = OrderSchema(
-                model=shop_data.models[0],
-                model_code=shop_data.code,
-                country=shop_data.country,
-                ac_type=ac_type,
-                ac_model=ac_model
-            )
-            self.enable_order(order_data)
-
-        ignore_wait = False
-        while not self.is_stop:
-            try:
-                ignore_wait = False
-                inventory_data = self.get_data(
-                    shop_data.country,
-                    shop_data.models,
-                    shop_data.location,
+            if not wishes:
+                # without a wishlist, the first product of the first target for one buyer
+                # fixme Is there a better way to obtain the model code?
+                wishes = [
+                    WishSchema(
+                        model=targets[0].models[0],
+                        model_code=targets[0].code,
+                        buyer="default",
+                        ac_type=ac_type,
+                        ac_model=ac_model,
+                    )
+                ]
+                buyers = {"default": delivery_data}
+            self.enable_order(
+                OrderDispatcher(
+                    targets[0].country,
+                    wishes,
+                    buyers or {},
+                    race_count=order_race_count,
+                    stage_interval=order_stage_interval,
+                    host=self.order_host,
+                    cluster=self.cluster,
                 )
-                pickup_lists = self.parse_data(inventory_data)
-                pickup_lists = [i for i in pickup_lists if not shop_data.store_filters or any(
-                        [
-                            True
-                            for ii in shop_data.store_filters
-                            if ii in i.store_name
-                        ]
-                    )]
-
-                if not pickup_lists:
-                    logger.warning("No available stores found")
-                    time.sleep(interval)
+            )
+
+        tasks = [
+            MonitorTask(
+                i,
+                scheduler=self.get_scheduler(i, i.interval or interval),
+                store_pattern=compile_store_filters(i.store_filters),
+            )
+            for i in targets
+        ]
+        self.run(tasks)
+
+        # deliver the remaining notifications before exiting
+        self.notifier.join()
+        self.history and self.history.close()
+        sys.exit(0)
+
+    def get_scheduler(self, shop_data: ShopSchema, interval: int) -> PollScheduler:
+        if self.planner:
+            return PlannedScheduler(interval, self.planner, shop_data)
+        return self.scheduler_class(interval)
+
+    def run(self, tasks: list[MonitorTask]):
+        """Poll every target on its own schedule until stopped"""
+        # the first queries of every worker skip the tcp and tls handshakes
+        self.session.warm(count=min(len(tasks), self.max_workers))
+        counter = itertools.count()
+        schedules = [(0.0, next(counter), i) for i in tasks]
+        with ThreadPoolExecutor(
+            max_workers=min(len(tasks), self.max_workers),
+            thread_name_prefix="Monitor",
+        ) as executor:
+            while not self.is_stop:
+                now = time.time()
+                while schedules and schedules[0][0] <= now:
+                    _, _, task = heapq.heappop(schedules)
+                    executor.submit(self.run_task, task)
+
+                wait = schedules[0][0] - now if schedules else None
+                try:
+                    task = self.done_tasks.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if task is None:
                     continue
+                heapq.heappush(schedules, (task.next_run, next(counter), task))
 
-                for pickup in pickup_lists:
-                    logger.info(pickup.intro())
-
-                available_lists = [i for i in pickup_lists if i.status == DeliveryStatusEnum.AVAILABLE]
-                if available_lists and notification_providers:
-                    self.push_notifications(available_lists, notification_providers)
-
-                if available_lists and order:
-                    for pickup in available_lists:
-                        order_data.store_number = pickup.store_number
-                        order_data.state = pickup.state
-                        order_data.city = pickup.city
-                        order_data.district = pickup.district
-                        order_data.delivery = delivery_data
-
-                        order_result = self.start_order(
-                            order_data,
-                            notification_providers,
-                            notice_count=order_notice_count,
-                        )
-                        if order_result is False:
-                            ignore_wait = True
-
-            except Exception as e:
-                logging.exception(
-                    "Failed to retrieve inventory data with error: ", exc_info=e
-                )
-                ignore_wait = True
-            if not ignore_wait:
-                time.sleep(interval)
+    def run_task(self, task: MonitorTask):
+        try:
+            if self.is_owned(task):
+                self.poll(task)
+                self.poll_succeeded(task)
+        except Exception as e:
+            self.poll_failed(task, e)
+        finally:
+            task.next_run = time.time() + task.scheduler.next_delay()
+            self.done_tasks.put(task)
+
+    def is_owned(self, task: MonitorTask) -> bool:
+        if not self.cluster:
+            return True
+        owned = self.cluster.owns(task.shop_data.key())
+        self.planner and self.planner.set_owned(task.shop_data.key(), owned)
+        if owned:
+            return True
+        # the stock seen before is outdated once the target comes back
+        task.snapshot = InventorySnapshot()
+        return False
 
-    def enable_order(self, data: OrderSchema):
-        self.order_pool = OrderSessionPool()
-        self.order_pool.start(data)
+    def poll_succeeded(self, task: MonitorTask):
+        task.scheduler.on_success(task.snapshot.has_available())
+        poll_total.inc(country=task.shop_data.country, result="success")
 
-    def start_order(
+    def poll_failed(self, task: MonitorTask, e: Exception):
+        poll_total.inc(country=task.shop_data.country, result=type(e).__name__)
+        logging.exception(
+            f"Failed to retrieve inventory data of {task.shop_data.intro()} with error: ",
+            exc_info=e,
+        )
+        task.scheduler.on_error(e)
+
+    def poll(self, task: MonitorTask):
+        shop_data = task.shop_data
+        self.rate_limiter and self.rate_limiter.acquire()
+        inventory_data = self.get_data(
+            shop_data.country,
+            shop_data.models,
+            shop_data.location,
+            shop_data.postal_code,
+            shop_data.state,
+        )
+        events = self.update_snapshot(task, inventory_data)
+        if events:
+            self.handle_events(task, events)
+
+    def update_snapshot(
+        self, task: MonitorTask, inventory_data: dict
+    ) -> list[InventoryEventSchema]:
+        shop_data = task.shop_data
+        if self.order_dispatcher and self.order_dispatcher.need_candidates():
+            # every filtered store whatever its status
+            self.order_dispatcher.set_candidates(
+                list(self.iter_data(inventory_data, store_pattern=task.store_pattern))
+            )
+
+        # only available parts are tracked, anything missing is unavailable
+        pickups = self.iter_data(
+            inventory_data,
+            store_pattern=task.store_pattern,
+            statuses={DeliveryStatusEnum.AVAILABLE.value},
+        )
+        is_first = not task.snapshot.initialized
+        # the pickups are parsed lazily while the snapshot consumes them
+        with parse_seconds.time():
+            events = task.snapshot.update(pickups)
+        if self.history:
+            # only queued, the writer thread batches the inserts
+            self.history.record(shop_data.key(), len(task.snapshot.deliveries), events)
+        if is_first:
+            logger.info(
+                f"Start monitoring {shop_data.intro()}, {len(events)} store parts available"
+            )
+        return events
+
+    def handle_events(self, task: MonitorTask, events: list[InventoryEventSchema]):
+        self.notify_events(task, events)
+        if not self.order_dispatcher:
+            return
+        self.order_dispatcher.discard(
+            [i for i in events if i.type == InventoryEventEnum.UNAVAILABLE]
+        )
+        succeeded, retry_events = self.order_dispatcher.dispatch(
+            [i for i in events if i.type == InventoryEventEnum.AVAILABLE]
+        )
+        self.handle_order_results(task, succeeded, retry_events)
+
+    def notify_events(self, task: MonitorTask, events: list[InventoryEventSchema]):
+        for event in events:
+            logger.info(event.intro())
+            events_total.inc(type=event.type)
+
+        notify_events = [i for i in events if i.type != InventoryEventEnum.UNAVAILABLE]
+        if notify_events and self.notification_providers:
+            self.push_notifications(
+                notify_events,
+                self.notification_providers,
+                key=f"inventory_monitor_{task.shop_data.intro()}",
+            )
+
+    def handle_order_results(
         self,
-        data: OrderSchema,
-        notification_providers: list[NotificationBase],
-        notice_count: int,
+        task: MonitorTask,
+        succeeded: list[str],
+        retry_events: list[InventoryEventSchema],
     ):
-        order_obj = self.order_pool.get()
-        order_result = order_obj.start_order(data)
-        if order_result:
-            for provider in notification_providers:
-                title, content = (
-                    "Order success notification",
-                    "Check your email for detailed information.",
-                )
-                provider.repeat_push(title, content, max_count=notice_count)
+        for event in retry_events:
+            # try again on the next query while the stock lasts
+            task.snapshot.forget(event.key())
+        for buyer in succeeded:
+            self.order_success(buyer)
+        if succeeded and self.order_dispatcher.is_done():
             logger.info(
                 "The order has been successfully placed, and the program will automatically exit."
             )
             self.stop()
-        return order_result
+
+    def enable_order(self, order_dispatcher: OrderDispatcher):
+        self.order_dispatcher = order_dispatcher
+        self.order_dispatcher.start()
+
+    def order_success(self, buyer: str):
+        for provider in self.notification_providers:
+            title, content = (
+                "Order success notification",
+                "Check your email for detailed information.",
+            )
+            if buyer != "default":
+                content = f"{buyer}: {content}"
+            self.notifier.repeat_push(
+                provider, title, content, max_count=self.order_notice_count
+            )
+        logger.info(f"The order of {buyer} has been successfully placed.")
 
     def push_notifications(
-        self, pickup_lists: list[DeliverySchema], providers: list[NotificationBase]
+        self,
+        events: list[InventoryEventSchema],
+        providers: list[NotificationBase],
+        key: str = "inventory_monitor",
     ):
         title = "Apple inventory notification"
         buffers = []
-        for pickup in pickup_lists:
-            buffers.append(pickup.intro())
+        for event in events:
+            # another node may have seen the same event
+            if self.cluster and not self.cluster.claim_notification(
+                f"{event.type}/{'/'.join(event.key())}/{event.delivery.pickup_quote}",
+                ttl=60,
+            ):
+                continue
+            buffers.append(event.intro())
 
         if not buffers:
             return
 
         for provider in providers:
-            try:
-                provider.push(
-                    title,
-                    "\r\n".join(buffers),
-                    key=f"inventory_monitor_{provider.name}",
-                    min_interval=60,
-                )
-            except Exception as e:
-                logging.exception(
-                    "Inventory information push failed with error: ", exc_info=e
-                )
+            self.notifier.push(
+                provider,
+                title,
+                "\r\n".join(buffers),
+                key=key,
+                min_interval=60,
+            )
 
     def get_data(
         self,
@@ -162,6 +441,22 @@ class InventoryMonitor(object):
         postal_code: str = "",
         state: str = "",
     ):
+        search_params = self.get_search_params(models, location, postal_code, state)
+        with poll_seconds.time(country=country):
+            resp = self.session.get(
+                f"/{country}/shop/fulfillment-messages",
+                params=search_params,
+                hedge=True,
+            )
+        # 503/429 are handed to the scheduler with their Retry-After
+        resp.raise_for_status()
+
+        return resp.json()
+
+    @staticmethod
+    def get_search_params(
+        models: list[str], location: str = "", postal_code: str = "", state: str = ""
+    ) -> dict:
         parts = {f"parts.{idx}": i for idx, i in enumerate(models)}
         search_params = {
             "searchNearby": "true",
@@ -175,44 +470,71 @@ class InventoryMonitor(object):
             search_params["postalCode"] = postal_code
         if state:
             search_params["state"] = state
+        return search_params
 
-        resp = self.session.get(
-            f"/{country}/shop/fulfillment-messages", params=search_params
-        )
-
-        return resp.json()
+    def parse_data(
+        self,
+        data: dict,
+        store_filters: Optional[list[str]] = None,
+        statuses: Optional[set[str]] = None,
+    ) -> list[DeliverySchema]:
+        with parse_seconds.time():
+            return list(
+                self.iter_data(
+                    data,
+                    store_pattern=compile_store_filters(store_filters),
+                    statuses=statuses,
+                )
+            )
 
-    def parse_data(self, data: dict):
+    def iter_data(
+        self,
+        data: dict,
+        store_pattern: Optional[re.Pattern] = None,
+        statuses: Optional[set[str]] = None,
+    ) -> Iterator[DeliverySchema]:
+        """Only build records of the stores and statuses that pass the filters"""
         pickup_message = data["body"]["content"]["pickupMessage"]
         if not pickup_message.get("stores"):
             logger.error("No stores found")
-            return []
-        deliveries = []
+            return
+        is_matched = False
         for store in pickup_message["stores"]:
-            parts = store["partsAvailability"].values()
-            for part in parts:
-                address = store["retailStore"]["address"]
+            store_name = store["storeName"]
+            if store_pattern and not store_pattern.search(store_name):
+                continue
+            is_matched = True
+            address = None
+            for part in store["partsAvailability"].values():
+                status = part["pickupDisplay"]
+                if statuses and status not in statuses:
+                    continue
+                if address is None:
+                    address = store["retailStore"]["address"]
+                    store_name = sys.intern(store_name)
+                    store_number = sys.intern(store["storeNumber"])
                 model_name = part["messageTypes"]["regular"][
                     "storePickupProductTitle"
                 ].replace("\xa0", " ")
-                deliveries.append(
-                    DeliverySchema(
-                        state=address["state"],
-                        city=address["city"],
-                        district=address["district"],
-                        store_name=store["storeName"],
-                        store_number=store["storeNumber"],
-                        model_name=model_name,
-                        pickup_quote=part["pickupSearchQuote"],
-                        model=part["partNumber"],
-                        status=part["pickupDisplay"],
-                        pickup_type=part["pickupType"],
-                    )
+                # interned, so long running snapshots share one copy of the repeated strings
+                yield DeliverySchema(
+                    state=address["state"],
+                    city=address["city"],
+                    district=address["district"],
+                    store_name=store_name,
+                    store_number=store_number,
+                    model_name=sys.intern(model_name),
+                    pickup_quote=part["pickupSearchQuote"],
+                    model=sys.intern(part["partNumber"]),
+                    status=sys.intern(status),
+                    pickup_type=sys.intern(part["pickupType"]),
                 )
-
-        return deliveries
+        if not is_matched:
+            # most likely a typo in the store filter
+            logger.warning("No available stores found")
 
     def stop(self):
         self.is_stop = True
-        self.order_pool and self.order_pool.stop()
-        sys.exit(0)
+        self.order_dispatcher and self.order_dispatcher.stop()
+        # wake up the scheduler
+        self.done_tasks.put(None)
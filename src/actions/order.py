@@ -1,28 +1,45 @@
 import dataclasses
-import json
 import logging
 import random
-import re
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Optional
 from urllib.parse import urlparse, parse_qsl, quote_plus
 
+from actions.checkout import CheckoutStateMachine
 from common.schemas import OrderSchema
+from libs.metrics import registry
+from libs.pages import extract_json
 from libs.requests import Request
+from libs.scheduler import PollBackoff
 
 apple_api_host = "https://www.apple.com"
 
 logger = logging.getLogger(__name__)
 
+pool_sessions = registry.gauge(
+    "apple_order_pool_sessions", "Order sessions of a pool by state", ("pool", "state")
+)
+pool_oldest_age = registry.gauge(
+    "apple_order_pool_oldest_session_age_seconds",
+    "Age of the oldest ready order session",
+    ("pool",),
+)
+session_init_seconds = registry.histogram(
+    "apple_order_session_init_seconds",
+    "Time to initialise an order session",
+    ("result",),
+)
+
 
 class Order(object):
-    def __init__(self, country: str) -> None:
+    def __init__(self, country: str, host: Optional[str] = None) -> None:
         super().__init__()
         # only support cn yet
         assert country == "cn", "Only support cn yet"
-        api_host = apple_api_host + ".cn"
+        api_host = host or apple_api_host + ".cn"
         self.session = Request(
             api_host,
             headers={
@@ -31,6 +48,11 @@ class Order(object):
             },
         )
         self.secure_host = ""
+        # pickup store selected ahead of time, see stage_store
+        self.staged_store = ""
+        self.staged_window: Optional[dict] = None
+        self.staged_at = 0.0
+        self.staged_max_age = 60.0
 
     def init_order(self, order_data: OrderSchema):
         self.add_to_cart(order_data.model, order_data.model_code, order_data.ac_type, order_data.ac_model)
@@ -54,11 +76,33 @@ class Order(object):
 
         self.update_delivery_method()
 
-    def start_order(self, order_data: OrderSchema):
+    def start_order(self, order_data: OrderSchema, race: Optional["OrderRace"] = None):
+        """
+        True when the order is placed, False when the store has no pickup time slot,
+        None when another attempt of the race reached placing the order first.
+        Once the order is placed it returns True, see CheckoutStateMachine.
+        """
+        return self.get_checkout(order_data, race).run()
+
+    async def start_order_async(
+        self, order_data: OrderSchema, race: Optional["OrderRace"] = None
+    ):
+        """start_order on an event loop"""
+        return await self.get_checkout(order_data, race).run_async()
+
+    def get_checkout(
+        self, order_data: OrderSchema, race: Optional["OrderRace"] = None
+    ) -> CheckoutStateMachine:
         logger.info(
             f"Order starting with {order_data.model_code} {order_data.model} {order_data.state} {order_data.city}..."
         )
+        return CheckoutStateMachine(self, order_data, race=race)
 
+    def select_window(self, order_data: OrderSchema) -> Optional[dict]:
+        selected_window = self.get_staged_window(order_data.store_number)
+        if selected_window:
+            logger.info("Use the staged pickup time slot")
+            return selected_window
         address_data = self.fill_address(
             order_data.store_number,
             order_data.country,
@@ -66,33 +110,43 @@ class Order(object):
             order_data.city,
             order_data.district,
         )
-
-        selected_window = self.get_select_window(address_data)
-        if not selected_window:
-            return False
-
-        self.fill_contact(
-            selected_window,
+        return self.get_select_window(address_data)
+
+    def stage_store(self, order_data: OrderSchema, max_age: float = 60):
+        """
+        Select the pickup store and fetch its time slots before the stock shows up,
+        the slots are used for max_age seconds.
+        """
+        self.staged_window = None
+        address_data = self.fill_address(
             order_data.store_number,
             order_data.country,
             order_data.state,
             order_data.city,
             order_data.district,
         )
-
-        self.fill_recipient(
-            order_data.delivery.first_name,
-            order_data.delivery.last_name,
-            order_data.delivery.email,
-            order_data.delivery.phone,
-            order_data.delivery.idcard,
-        )
-        self.fill_pay_method(
-            order_data.delivery.payment, order_data.delivery.payment_number
-        )
-        self.finish_checkout()
-
-        return True
+        self.staged_store = order_data.store_number
+        self.staged_at = time.time()
+        self.staged_max_age = max_age
+        try:
+            self.staged_window = self.get_select_window(address_data)
+        except AssertionError:
+            self.staged_window = None
+
+    def get_staged_window(self, store_number: str) -> Optional[dict]:
+        if (
+            self.staged_store == store_number
+            and self.staged_window
+            and time.time() - self.staged_at < self.staged_max_age
+        ):
+            return self.staged_window
+        return None
+
+    def warm(self):
+        """Keep the connections of the store and the checkout alive between orders"""
+        self.session.warm()
+        if self.secure_host:
+            self.session.warm(self.secure_host)
 
     def get_cart_item_id(self):
         logger.info("Getting cart id...")
@@ -158,7 +212,7 @@ class Order(object):
         url_parsed = urlparse(signin_url)
 
         signin_params = dict(parse_qsl(url_parsed.query))
-        secure_api_host = f"{url_parsed.scheme}://{url_parsed.hostname}"
+        secure_api_host = f"{url_parsed.scheme}://{url_parsed.netloc}"
 
         logger.debug(f"Secure api host: {secure_api_host}")
         return signin_url, signin_params, secure_api_host
@@ -384,144 +438,365 @@ class Order(object):
             data=data,
         )
 
-    def finish_checkout(self, show_cookie: bool = False):
-        logger.info("Starting final checkout...")
-
-        place_order_data = self.get_place_order_data()
-
+    def process_order(self, place_order_data: dict, timeout: float = 60):
         self.get_page_with_meta(
             self.secure_host + place_order_data["head"]["data"]["url"], None
         )
 
-        status_data = self.get_checkout_status_x()
+        return self.get_checkout_status_x(timeout=timeout)
 
-        if show_cookie:
-            cookie_str = "; ".join(
-                [f"{k}={v}" for k, v in self.session.session.cookies.get_dict().items()]
-            )
-
-            logger.info("Order page cookies: %s", cookie_str)
-
-        while True:
+    def get_order_number(self, place_order_data: dict, timeout: float = 120) -> str:
+        def get_thank_data():
             thank_data = self.get_page_with_meta(
                 self.secure_host + place_order_data["head"]["data"]["url"], None
             )
             thank_you_interstitial = thank_data.get("thankYouInterstitial") or {}
             order_data = thank_you_interstitial.get("d") or {}
-            order_number = order_data.get("orderNumber")
-            if order_number:
-                logger.info(f"Order done, order number: {order_number}.")
-                break
-            time.sleep(1)
+            return order_data.get("orderNumber")
+
+        order_number = self.poll(get_thank_data, timeout, "Order number")
+        logger.info(f"Order done, order number: {order_number}.")
+        return order_number
 
-    def get_place_order_data(self):
+    def get_place_order_data(self, timeout: float = 30):
         logger.info("Get order data...")
-        place_order_data = self.checkout_request(
-            self.secure_host + "/shop/checkoutx",
-            params={
-                "_a": "continueFromReviewToProcess",
-                "_m": "checkout.review.placeOrder",
-            },
-            assert_code=302,
+        return self.poll(
+            lambda: self.checkout_request(
+                self.secure_host + "/shop/checkoutx",
+                params={
+                    "_a": "continueFromReviewToProcess",
+                    "_m": "checkout.review.placeOrder",
+                },
+                assert_code=302,
+            ),
+            timeout,
+            "Place order",
         )
-        if place_order_data is False:
-            time.sleep(1)
-            return self.get_place_order_data()
-        return place_order_data
 
-    def get_checkout_status_x(self):
+    def get_checkout_status_x(self, timeout: float = 60):
         logger.info("Get order status...")
-        status_data = self.checkout_request(
-            self.secure_host + "/shop/checkoutx/statusX",
-            params={
-                "_a": "checkStatus",
-                "_m": "spinner",
-            },
-            assert_code=302,
+        return self.poll(
+            lambda: self.checkout_request(
+                self.secure_host + "/shop/checkoutx/statusX",
+                params={
+                    "_a": "checkStatus",
+                    "_m": "spinner",
+                },
+                assert_code=302,
+            ),
+            timeout,
+            "Order status",
         )
-        if status_data is False:
-            time.sleep(1)
-            return self.get_checkout_status_x()
-        return status_data
+
+    @staticmethod
+    def poll(func, timeout: float, name: str):
+        """Call func until it returns a result, fast at first and then backing off"""
+        backoff = PollBackoff(timeout)
+        while True:
+            result = func()
+            if result is not None and result is not False:
+                return result
+            if not backoff.wait():
+                raise TimeoutError(f"{name} is not ready after {timeout}s")
 
     def get_page_with_meta(self, url, params, data: Optional[dict] = None):
+        # not hedged, a duplicate load would set the cookies and the x-aos-stk twice
         page_resp = self.session.get(url, params=params, data=data)
         assert page_resp.status_code == 200
-        page_content = page_resp.text
-        assert "x-aos-stk" in page_content
-        cart_meta_match = re.search(
-            r"<script id=\"init_data\" type=\"application/json\">(.+?)</script>",
-            page_content,
-            flags=re.DOTALL,
+        meta_json_data = extract_json(
+            page_resp.text, '<script id="init_data" type="application/json">'
         )
-        assert cart_meta_match
-        meta_json = cart_meta_match.group(1)
-        meta_json_data = json.loads(meta_json.strip())
         headers = meta_json_data["meta"]["h"]
+        assert "x-aos-stk" in headers
         self.session.session.headers.update(headers)
 
         return meta_json_data
 
 
+class OrderRace(object):
+    """Concurrent checkout attempts for one order, the first one to place the order wins"""
+
+    def __init__(self, renew: Optional[Callable[[], bool]] = None) -> None:
+        """renew keeps the order lease of the cluster, called before every checkout step"""
+        super().__init__()
+        self.lock = threading.Lock()
+        self.winner = ""
+        self.renew = renew
+
+    def claim(self, store_number: str) -> bool:
+        with self.lock:
+            if not self.winner:
+                self.winner = store_number
+            return self.winner == store_number
+
+    def is_lost(self, store_number: str) -> bool:
+        return bool(self.winner) and self.winner != store_number
+
+
 @dataclasses.dataclass()
 class PoolData(object):
     order: Order
     timestamp: float
     available: bool = True
+    # pickup store the session is staged for
+    store_number: str = ""
+    staged_at: float = 0
+    # when a failed stage is tried again
+    stage_retry_at: float = 0
+    warmed_at: float = 0
+    busy: bool = False
 
 
 class OrderSessionPool(object):
-    def __init__(self, timeout: int = 60 * 30) -> None:
+    """
+    Initialised order sessions kept warm. Sessions are created in parallel, expired
+    or consumed ones are replaced right away and get() wakes as soon as one is ready.
+    A session from get() is busy until release(), one that lost a race goes back idle.
+    With stage_interval, sessions are also staged against the candidate stores and
+    their time slots are refreshed every stage_interval seconds.
+    Idle sessions reopen their connections every keepalive_interval seconds.
+    """
+
+    def __init__(
+        self,
+        timeout: int = 60 * 30,
+        size: int = 3,
+        stage_interval: int = 0,
+        name: str = "default",
+        host: Optional[str] = None,
+        keepalive_interval: int = 60,
+    ) -> None:
         super().__init__()
+        self.name = name
+        self.host = host
+        self.keepalive_interval = keepalive_interval
         self.timeout = timeout
+        self.size = size
+        self.stage_interval = stage_interval
         self.pools: list[PoolData] = []
         self.redundant_time = 60 * 5
-        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.creating = 0
         self.is_stop = False
+        self.order_data: Optional[OrderSchema] = None
+        self.candidates: list[OrderSchema] = []
+        self.executor: Optional[ThreadPoolExecutor] = None
 
     def start(self, order_data: OrderSchema):
-        thread = threading.Thread(
-            target=self.handle_pool, args=(order_data,), name="OrderPool"
+        self.order_data = order_data
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.size, thread_name_prefix="OrderSession"
         )
+        thread = threading.Thread(target=self.handle_pool, name="OrderPool")
         thread.start()
+        pool_oldest_age.set_function(self.get_oldest_age, pool=self.name)
+
+    def get_oldest_age(self) -> float:
+        pools = self.pools
+        if not pools:
+            return 0
+        return time.time() - min(i.timestamp for i in pools)
 
-    def handle_pool(self, order_data: OrderSchema, max_count: int = 3):
+    def set_candidates(self, candidates: list[OrderSchema]):
+        """Stores to stage sessions against, at most one per session"""
+        with self.condition:
+            self.candidates = candidates[: self.size]
+            self.condition.notify_all()
+
+    def handle_pool(self):
         timeout = self.timeout - self.redundant_time
         logger.info("Start maintaining the order session pool...")
+        last_pool_state = None
         while not self.is_stop:
-            for pool in self.pools:
-                if time.time() - pool.timestamp >= timeout:
-                    pool.available = False
-            with self.lock:
+            with self.condition:
+                now = time.time()
+                for pool in self.pools:
+                    if now - pool.timestamp >= timeout and not pool.busy:
+                        pool.available = False
                 self.pools = [i for i in self.pools if i.available]
-
-            logger.info(f"Number of available order session pools: {len(self.pools)}")
-
-            while max_count - len(self.pools) > 0:
-                pool_data = self.new(order_data)
-                with self.lock:
+                missing = self.size - len(self.pools) - self.creating
+                self.creating += max(missing, 0)
+                stages = self.get_stages()
+                warms = self.get_warms()
+
+            for _ in range(missing):
+                self.executor.submit(self.create)
+            for pool_data, candidate in stages:
+                self.executor.submit(self.stage, pool_data, candidate)
+            for pool_data in warms:
+                self.executor.submit(self.warm, pool_data)
+
+            with self.condition:
+                pool_state = (len(self.pools), self.creating)
+                busy = sum(1 for i in self.pools if i.busy)
+                pool_sessions.set(pool_state[0] - busy, pool=self.name, state="idle")
+                pool_sessions.set(busy, pool=self.name, state="busy")
+                pool_sessions.set(pool_state[1], pool=self.name, state="creating")
+                if pool_state != last_pool_state:
+                    logger.info(
+                        f"Number of available order session pools: {pool_state[0]}, creating: {pool_state[1]}"
+                    )
+                    last_pool_state = pool_state
+                wake_times = [i.timestamp + timeout for i in self.pools]
+                if self.stage_interval and self.candidates:
+                    wake_times += [
+                        max(i.staged_at + self.stage_interval, i.stage_retry_at)
+                        for i in self.pools
+                        if not i.busy
+                    ]
+                if self.keepalive_interval:
+                    wake_times += [
+                        i.warmed_at + self.keepalive_interval
+                        for i in self.pools
+                        if not i.busy
+                    ]
+                next_wake = min(wake_times, default=None)
+                # woken up early when a session is consumed, created, staged or failed
+                self.condition.wait(
+                    timeout=max(next_wake - time.time(), 0)
+                    if next_wake is not None
+                    else None
+                )
+
+    def get_stages(self) -> list[tuple[PoolData, OrderSchema]]:
+        """Idle sessions that are not staged yet or whose time slots are outdated"""
+        if not self.stage_interval or not self.candidates:
+            return []
+        now = time.time()
+        candidate_maps = {i.store_number: i for i in self.candidates}
+        counts = {i: 0 for i in candidate_maps}
+        for pool in self.pools:
+            if pool.store_number in counts:
+                counts[pool.store_number] += 1
+
+        stages = []
+        for pool in self.pools:
+            if pool.busy or now < pool.stage_retry_at:
+                continue
+            if pool.store_number not in candidate_maps:
+                store_number = min(counts, key=lambda x: counts[x])
+                counts[store_number] += 1
+            elif now - pool.staged_at >= self.stage_interval:
+                store_number = pool.store_number
+            else:
+                continue
+            pool.busy = True
+            stages.append((pool, candidate_maps[store_number]))
+        return stages
+
+    def get_warms(self) -> list[PoolData]:
+        """Idle sessions whose connections may have been closed by the server"""
+        if not self.keepalive_interval:
+            return []
+        now = time.time()
+        warms = []
+        for pool in self.pools:
+            if not pool.busy and now - pool.warmed_at >= self.keepalive_interval:
+                # a session is not thread safe, get() waits until the warm-up ends
+                pool.busy = True
+                pool.warmed_at = now
+                warms.append(pool)
+        return warms
+
+    def warm(self, pool_data: PoolData):
+        try:
+            pool_data.order.warm()
+        finally:
+            with self.condition:
+                pool_data.busy = False
+                self.condition.notify_all()
+
+    def stage(self, pool_data: PoolData, candidate: OrderSchema):
+        is_staged = False
+        try:
+            # the slots are refreshed every stage_interval, a refresh may take a while
+            pool_data.order.stage_store(candidate, max_age=self.stage_interval + 60)
+            is_staged = True
+            logger.debug(f"Order session staged for store {candidate.store_number}")
+        except Exception as e:
+            logging.exception("Stage order fail with error", exc_info=e)
+        finally:
+            with self.condition:
+                if is_staged:
+                    pool_data.store_number = candidate.store_number
+                    pool_data.staged_at = time.time()
+                else:
+                    pool_data.store_number = ""
+                    retry_delay = min(self.stage_interval, 10)
+                    pool_data.stage_retry_at = time.time() + retry_delay
+                pool_data.busy = False
+                self.condition.notify_all()
+
+    def create(self):
+        pool_data = None
+        try:
+            pool_data = self.new(self.order_data)
+        finally:
+            with self.condition:
+                self.creating -= 1
+                if pool_data:
                     self.pools.append(pool_data)
-            time.sleep(30)
+                self.condition.notify_all()
 
-    def new(self, order_data: OrderSchema) -> PoolData:
-        try:
+    def new(self, order_data: OrderSchema, max_retries: int = 5) -> Optional[PoolData]:
+        for attempt in range(max_retries):
+            if self.is_stop:
+                return None
             create_timestamp = time.time()
-            order = Order(order_data.country)
-            order.init_order(order_data)
-            return PoolData(order=order, timestamp=create_timestamp)
-        except Exception as e:
-            logging.exception("Init order fail with error", exc_info=e)
-            time.sleep(1)
-            return self.new(order_data)
+            try:
+                order = Order(order_data.country, host=self.host)
+                order.init_order(order_data)
+                session_init_seconds.observe(
+                    time.time() - create_timestamp, result="success"
+                )
+                return PoolData(
+                    order=order, timestamp=create_timestamp, warmed_at=time.time()
+                )
+            except Exception as e:
+                session_init_seconds.observe(
+                    time.time() - create_timestamp, result="failure"
+                )
+                logging.exception("Init order fail with error", exc_info=e)
+                time.sleep(min(2**attempt, 30))
+        return None
 
     def stop(self):
-        self.is_stop = True
-
-    def get(self) -> Order:
-        while True:
-            if not self.pools:
-                time.sleep(0.1)
-                continue
-            with self.lock:
-                pool_data = self.pools.pop(0)
+        with self.condition:
+            self.is_stop = True
+            self.condition.notify_all()
+        self.executor and self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get(
+        self, store_number: str = "", timeout: Optional[float] = None
+    ) -> Optional[Order]:
+        """
+        An idle session, the one staged for store_number is preferred.
+        It stays busy until release().
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.is_stop or any(not i.busy for i in self.pools),
+                timeout=timeout,
+            )
+            idles = [i for i in self.pools if not i.busy]
+            if self.is_stop or not idles:
+                return None
+            pool_data = next(
+                (i for i in idles if store_number and i.store_number == store_number),
+                idles[0],
+            )
+            pool_data.busy = True
             return pool_data.order
+
+    def release(self, order: Order, reusable: bool = False):
+        """Give back a session from get(), one that is not reusable is replaced"""
+        with self.condition:
+            pool_data = next((i for i in self.pools if i.order is order), None)
+            if not pool_data:
+                return
+            if reusable:
+                pool_data.busy = False
+            else:
+                self.pools.remove(pool_data)
+            # let the maintainer replace the consumed session or stage the idle one
+            self.condition.notify_all()
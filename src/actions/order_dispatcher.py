@@ -0,0 +1,319 @@
+import asyncio
+import dataclasses
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from actions.order import OrderSessionPool, OrderRace
+from common.schemas import (
+    DeliverySchema,
+    InventoryEventSchema,
+    OrderDeliverySchema,
+    OrderSchema,
+    WishSchema,
+)
+from libs.coordination import ClusterCoordinator
+
+logger = logging.getLogger(__name__)
+
+
+class OrderDispatcher(object):
+    """
+    Match available stock against a prioritised wishlist. Every (model, buyer) wish
+    keeps its own warm session pool and a buyer orders at most once.
+    """
+
+    def __init__(
+        self,
+        country: str,
+        wishes: list[WishSchema],
+        buyers: dict[str, OrderDeliverySchema],
+        race_count: int = 1,
+        stage_interval: int = 0,
+        pool_size: int = 3,
+        host: Optional[str] = None,
+        cluster: Optional[ClusterCoordinator] = None,
+        session_timeout: float = 30,
+    ) -> None:
+        super().__init__()
+        assert wishes, "At least one wish is required"
+        for wish in wishes:
+            assert wish.buyer in buyers, f"Unknown buyer {wish.buyer}"
+        self.country = country
+        # lower priority first, the original order breaks ties
+        self.wishes = sorted(wishes, key=lambda x: x.priority)
+        self.buyers = buyers
+        self.race_count = max(race_count, 1)
+        self.stage_interval = stage_interval
+        self.pool_size = max(pool_size, self.race_count)
+        self.host = host
+        # one node of the cluster orders for a buyer at a time, and a buyer once
+        self.cluster = cluster
+        # waiting for an idle session must not outlast the order lease
+        self.session_timeout = session_timeout
+
+        self.pools: dict[tuple[str, str], OrderSessionPool] = {}
+        self.fulfilled: set[str] = set()
+        self.busy: set[str] = set()
+        # wanted stock no free buyer could take, tried when a buyer's order fails
+        self.deferred: dict[tuple[str, str], InventoryEventSchema] = {}
+        self.lock = threading.Lock()
+        self.has_candidates = False
+
+    def start(self):
+        for wish in self.wishes:
+            key = (wish.model, wish.buyer)
+            if key in self.pools:
+                continue
+            pool = OrderSessionPool(
+                size=self.pool_size,
+                stage_interval=self.stage_interval,
+                name=f"{wish.model}/{wish.buyer}",
+                host=self.host,
+            )
+            pool.start(self.get_order_data(wish))
+            self.pools[key] = pool
+
+    def stop(self):
+        for pool in self.pools.values():
+            pool.stop()
+
+    def get_order_data(
+        self, wish: WishSchema, pickup: Optional[DeliverySchema] = None
+    ) -> OrderSchema:
+        order_data = OrderSchema(
+            model=wish.model,
+            model_code=wish.model_code,
+            country=self.country,
+            delivery=self.buyers[wish.buyer],
+            ac_type=wish.ac_type,
+            ac_model=wish.ac_model,
+        )
+        if pickup:
+            order_data = dataclasses.replace(
+                order_data,
+                store_number=pickup.store_number,
+                state=pickup.state,
+                city=pickup.city,
+                district=pickup.district,
+            )
+        return order_data
+
+    def need_candidates(self) -> bool:
+        return bool(self.stage_interval) and not self.has_candidates
+
+    def set_candidates(self, deliveries: list[DeliverySchema]):
+        """Stage the sessions of every wish against the stores selling its model"""
+        for wish in self.wishes:
+            candidates = [
+                self.get_order_data(wish, i)
+                for i in deliveries
+                if i.model == wish.model
+            ]
+            if candidates:
+                logger.info(
+                    f"Stage {wish.buyer} {wish.model} sessions for stores: "
+                    f"{', '.join(i.store_number for i in candidates)}"
+                )
+                self.pools[(wish.model, wish.buyer)].set_candidates(candidates)
+                self.has_candidates = True
+
+    def is_done(self) -> bool:
+        return self.fulfilled.issuperset(i.buyer for i in self.wishes)
+
+    def discard(self, events: list[InventoryEventSchema]):
+        """Forget the deferred stock that is gone"""
+        with self.lock:
+            for event in events:
+                self.deferred.pop(event.key(), None)
+
+    def assign(
+        self, events: list[InventoryEventSchema]
+    ) -> dict[str, tuple[WishSchema, list[InventoryEventSchema]]]:
+        """
+        Stores for every free buyer, taken from its highest priority wish with stock.
+        A store goes to one buyer, the wanted ones left over are deferred.
+        """
+        assignments = {}
+        with self.lock:
+            keys = {i.key() for i in events}
+            events = events + [v for k, v in self.deferred.items() if k not in keys]
+            for wish in self.wishes:
+                if (
+                    wish.buyer in self.fulfilled
+                    or wish.buyer in self.busy
+                    or wish.buyer in assignments
+                ):
+                    continue
+                matched = [i for i in events if i.delivery.model == wish.model]
+                if not matched:
+                    continue
+                if self.cluster and not self.acquire_lease(wish):
+                    # ordering on another node, its other wishes wait as well
+                    assignments[wish.buyer] = None
+                    continue
+                assignments[wish.buyer] = (wish, matched[: self.race_count])
+                events = [i for i in events if i not in matched[: self.race_count]]
+            assignments = {k: v for k, v in assignments.items() if v}
+            self.busy.update(assignments)
+
+            wanted_models = {
+                i.model for i in self.wishes if i.buyer not in self.fulfilled
+            }
+            self.deferred = {
+                i.key(): i for i in events if i.delivery.model in wanted_models
+            }
+        return assignments
+
+    def dispatch(
+        self, events: list[InventoryEventSchema]
+    ) -> tuple[list[str], list[InventoryEventSchema]]:
+        """
+        Order the available stock, returns the buyers whose order is placed
+        and the events worth trying again.
+        """
+        succeeded, retry_events = [], []
+        assignments = self.assign(events)
+        while assignments:
+            with ThreadPoolExecutor(
+                max_workers=len(assignments), thread_name_prefix="OrderDispatch"
+            ) as executor:
+                futures = {
+                    buyer: executor.submit(self.race_orders, wish, items)
+                    for buyer, (wish, items) in assignments.items()
+                }
+            results = {buyer: future.result() for buyer, future in futures.items()}
+            assignments = self.settle(assignments, results, succeeded, retry_events)
+        return succeeded, retry_events
+
+    async def dispatch_async(
+        self, events: list[InventoryEventSchema]
+    ) -> tuple[list[str], list[InventoryEventSchema]]:
+        """dispatch on an event loop, every buyer races in its own task"""
+        succeeded, retry_events = [], []
+        # the order leases of a cluster block
+        assignments = await asyncio.to_thread(self.assign, events)
+        while assignments:
+            results = await asyncio.gather(
+                *(
+                    self.race_orders_async(wish, items)
+                    for wish, items in assignments.values()
+                )
+            )
+            assignments = await asyncio.to_thread(
+                self.settle,
+                assignments,
+                dict(zip(assignments, results)),
+                succeeded,
+                retry_events,
+            )
+        return succeeded, retry_events
+
+    def settle(
+        self,
+        assignments: dict[str, tuple[WishSchema, list[InventoryEventSchema]]],
+        results: dict[str, bool],
+        succeeded: list[str],
+        retry_events: list[InventoryEventSchema],
+    ) -> dict[str, tuple[WishSchema, list[InventoryEventSchema]]]:
+        """
+        Record the results into succeeded and retry_events,
+        returns the deferred stock assigned to the buyers that failed.
+        """
+        failed = []
+        for buyer, result in results.items():
+            wish, events = assignments[buyer]
+            if result:
+                succeeded.append(buyer)
+            else:
+                failed.append(buyer)
+                retry_events.extend(events)
+            if self.cluster:
+                result and self.cluster.set_fulfilled(buyer)
+                self.cluster.release_order(buyer)
+
+        with self.lock:
+            self.fulfilled.update(succeeded)
+            self.busy.difference_update(assignments)
+        return self.assign([]) if failed and self.deferred else {}
+
+    def acquire_lease(self, wish: WishSchema) -> bool:
+        if self.cluster.is_fulfilled(wish.buyer):
+            logger.info(f"The order of {wish.buyer} was placed by another node")
+            self.fulfilled.add(wish.buyer)
+            return False
+        return self.cluster.acquire_order(wish.buyer)
+
+    def get_race(self, wish: WishSchema) -> OrderRace:
+        if not self.cluster:
+            return OrderRace()
+        return OrderRace(
+            renew=functools.partial(self.cluster.acquire_order, wish.buyer)
+        )
+
+    def race_orders(self, wish: WishSchema, events: list[InventoryEventSchema]) -> bool:
+        """Checkout concurrently on separate sessions, the first to place the order wins"""
+        race = self.get_race(wish)
+        with ThreadPoolExecutor(
+            max_workers=len(events), thread_name_prefix="OrderRace"
+        ) as executor:
+            futures = [
+                executor.submit(self.start_order, wish, event.delivery, race)
+                for event in events
+            ]
+        return any(future.result() for future in futures)
+
+    def start_order(
+        self, wish: WishSchema, pickup: DeliverySchema, race: Optional[OrderRace] = None
+    ):
+        pool = self.pools[(wish.model, wish.buyer)]
+        order_obj = pool.get(pickup.store_number, timeout=self.session_timeout)
+        if not order_obj:
+            return False
+        result = False
+        try:
+            result = order_obj.start_order(self.get_order_data(wish, pickup), race=race)
+        except Exception as e:
+            logging.exception(
+                f"Order of {wish.buyer} at store {pickup.store_number} failed with error: ",
+                exc_info=e,
+            )
+        finally:
+            # a session that lost the race is still good for the next one
+            pool.release(order_obj, reusable=result is None)
+        return result
+
+    async def race_orders_async(
+        self, wish: WishSchema, events: list[InventoryEventSchema]
+    ) -> bool:
+        race = self.get_race(wish)
+        results = await asyncio.gather(
+            *(self.start_order_async(wish, event.delivery, race) for event in events)
+        )
+        return any(results)
+
+    async def start_order_async(
+        self, wish: WishSchema, pickup: DeliverySchema, race: Optional[OrderRace] = None
+    ):
+        pool = self.pools[(wish.model, wish.buyer)]
+        # waiting for an idle session blocks
+        order_obj = await asyncio.to_thread(
+            pool.get, pickup.store_number, self.session_timeout
+        )
+        if not order_obj:
+            return False
+        result = False
+        try:
+            result = await order_obj.start_order_async(
+                self.get_order_data(wish, pickup), race=race
+            )
+        except Exception as e:
+            logging.exception(
+                f"Order of {wish.buyer} at store {pickup.store_number} failed with error: ",
+                exc_info=e,
+            )
+        finally:
+            pool.release(order_obj, reusable=result is None)
+        return result
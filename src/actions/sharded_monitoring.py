@@ -0,0 +1,371 @@
+import dataclasses
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from actions.inventory_monitoring import InventoryMonitor, MonitorTask, apple_api_host
+from common.schemas import DeliverySchema, InventoryEventSchema, ShopSchema
+from libs.coordination import ClusterCoordinator, SqliteCoordinationStore
+from libs.history import HistoryWriter
+from libs.planner import RestockPlanner
+from libs.metrics import start_metrics_server
+from libs.recorder import ResponseRecorder
+from libs.requests import DnsCache, Request
+from libs.scheduler import PollScheduler, AdaptiveScheduler, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass()
+class ShardSettings(object):
+    """Process wide options of the supervisor, a spawned worker starts without them"""
+
+    host: str = apple_api_host
+    max_workers: int = 8
+    scheduler_class: type[PollScheduler] = AdaptiveScheduler
+    stage_candidates: bool = False
+    record: str = ""
+    hedging: bool = True
+    dns_cache_ttl: float = 0
+    # the metrics of worker n are served on metrics_port + n + 1
+    metrics_port: int = 0
+    cluster_db: str = ""
+    node_id: str = ""
+    history_db: str = ""
+    plan: bool = False
+    # the share of the worker, 0 without a cap
+    requests_per_minute: float = 0
+
+    def apply(self, shard: int):
+        if self.record:
+            Request.recorder = ResponseRecorder(self.record)
+        Request.hedging = self.hedging
+        if self.dns_cache_ttl:
+            DnsCache.install(self.dns_cache_ttl)
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port + shard + 1)
+
+    def get_cluster(self) -> Optional[ClusterCoordinator]:
+        if not self.cluster_db:
+            return None
+        # the heartbeat of the node is kept by the supervisor
+        return ClusterCoordinator(
+            SqliteCoordinationStore(self.cluster_db), self.node_id
+        )
+
+    def get_history(self) -> Optional[HistoryWriter]:
+        # every worker writes its own batches, WAL lets them take turns
+        return HistoryWriter(self.history_db) if self.history_db else None
+
+    def get_planner(self) -> Optional[RestockPlanner]:
+        if not self.plan:
+            return None
+        return RestockPlanner(
+            self.history_db, requests_per_minute=self.requests_per_minute
+        )
+
+    def get_rate_limiter(self) -> Optional[RateLimiter]:
+        return (
+            RateLimiter(self.requests_per_minute) if self.requests_per_minute else None
+        )
+
+
+@dataclasses.dataclass()
+class ShardMessage(object):
+    """From a worker, the events of one target or the stores to stage the orders against"""
+
+    target: int
+    events: list[InventoryEventSchema] = dataclasses.field(default_factory=list)
+    candidates: Optional[list[DeliverySchema]] = None
+
+
+@dataclasses.dataclass()
+class ShardCommand(object):
+    """To a worker, stock the coordinator failed to order is tried again on the next query"""
+
+    target: int
+    forget: list[tuple[str, str]]
+
+
+class ShardMonitor(InventoryMonitor):
+    """Polls a shard of the targets in a worker process, the events go to the coordinator"""
+
+    def __init__(
+        self,
+        targets: list[int],
+        messages: "multiprocessing.Queue[ShardMessage]",
+        commands: "multiprocessing.Queue[Optional[ShardCommand]]",
+        settings: ShardSettings,
+        known: Optional[list[list[DeliverySchema]]] = None,
+    ) -> None:
+        super().__init__(
+            max_workers=settings.max_workers,
+            scheduler_class=settings.scheduler_class,
+            host=settings.host,
+            cluster=settings.get_cluster(),
+            history=settings.get_history(),
+            planner=settings.get_planner(),
+            rate_limiter=settings.get_rate_limiter(),
+        )
+        # the global index of every target of the shard
+        self.targets = targets
+        self.messages = messages
+        self.commands = commands
+        self.stage_candidates = settings.stage_candidates
+        # the available stock of every target reported by the previous worker
+        self.known = known or []
+        self.tasks: dict[int, MonitorTask] = {}
+
+    def run(self, tasks: list[MonitorTask]):
+        self.tasks = dict(zip(self.targets, tasks))
+        for task, deliveries in zip(tasks, self.known):
+            task.snapshot.seed(deliveries)
+        threading.Thread(
+            target=self.handle_commands, name="ShardCommands", daemon=True
+        ).start()
+        super().run(tasks)
+
+    def get_target(self, task: MonitorTask) -> int:
+        return next(k for k, v in self.tasks.items() if v is task)
+
+    def update_snapshot(
+        self, task: MonitorTask, inventory_data: dict
+    ) -> list[InventoryEventSchema]:
+        if self.stage_candidates and not task.snapshot.initialized:
+            self.messages.put(
+                ShardMessage(
+                    self.get_target(task),
+                    candidates=list(
+                        self.iter_data(inventory_data, store_pattern=task.store_pattern)
+                    ),
+                )
+            )
+        return super().update_snapshot(task, inventory_data)
+
+    def handle_events(self, task: MonitorTask, events: list[InventoryEventSchema]):
+        self.messages.put(ShardMessage(self.get_target(task), events=events))
+
+    def handle_commands(self):
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                command = self.commands.get(timeout=5)
+            except queue.Empty:
+                # a killed coordinator never sends the stop
+                if parent.is_alive():
+                    continue
+                command = None
+            if command is None:
+                self.stop()
+                return
+            for key in command.forget:
+                self.tasks[command.target].snapshot.forget(key)
+
+
+def run_shard(
+    shard: int,
+    targets: list[int],
+    shop_data: list[ShopSchema],
+    messages: "multiprocessing.Queue[ShardMessage]",
+    commands: "multiprocessing.Queue[Optional[ShardCommand]]",
+    settings: ShardSettings,
+    known: list[list[DeliverySchema]],
+):
+    settings.apply(shard)
+    ShardMonitor(targets, messages, commands, settings, known).start(shop_data)
+
+
+class ShardedInventoryMonitor(InventoryMonitor):
+    """
+    Shard the targets across worker processes, so querying and parsing use every core.
+    The workers only poll, notifications and orders stay in this process,
+    so each event is pushed and ordered once. A restarted worker starts from
+    the stock its predecessor reported.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        max_workers: int = 8,
+        scheduler_class: type[PollScheduler] = AdaptiveScheduler,
+        host: str = apple_api_host,
+        order_host: Optional[str] = None,
+        metrics_port: int = 0,
+        cluster: Optional[ClusterCoordinator] = None,
+        history: Optional[HistoryWriter] = None,
+        planner: Optional[RestockPlanner] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        super().__init__(
+            max_workers=max_workers,
+            scheduler_class=scheduler_class,
+            host=host,
+            order_host=order_host,
+            cluster=cluster,
+            history=history,
+            planner=planner,
+            rate_limiter=rate_limiter,
+        )
+        self.workers = max(workers, 1)
+        self.metrics_port = metrics_port
+        # forking would copy the locks held by the notification and order threads
+        self.context = multiprocessing.get_context("spawn")
+        self.messages: "multiprocessing.Queue[Optional[ShardMessage]]" = (
+            self.context.Queue()
+        )
+        self.commands: list["multiprocessing.Queue[Optional[ShardCommand]]"] = []
+        self.processes: list[multiprocessing.Process] = []
+        self.spawned_at: list[float] = []
+        self.restarts: list[int] = []
+        self.tasks: list[MonitorTask] = []
+        self.targets: dict[int, int] = {}
+
+    def get_settings(self) -> ShardSettings:
+        return ShardSettings(
+            host=self.session.request_host,
+            max_workers=self.max_workers,
+            scheduler_class=self.scheduler_class,
+            stage_candidates=bool(
+                self.order_dispatcher and self.order_dispatcher.need_candidates()
+            ),
+            record=Request.recorder.directory if Request.recorder else "",
+            hedging=Request.hedging,
+            dns_cache_ttl=DnsCache.installed.ttl if DnsCache.installed else 0,
+            metrics_port=self.metrics_port,
+            cluster_db=self.cluster.store.path if self.cluster else "",
+            node_id=self.cluster.node_id if self.cluster else "",
+            history_db=self.history.path if self.history else "",
+            plan=bool(self.planner),
+            requests_per_minute=self.rate_limiter.rate * 60 if self.rate_limiter else 0,
+        )
+
+    def run(self, tasks: list[MonitorTask]):
+        self.tasks = tasks
+        self.targets = {id(task): idx for idx, task in enumerate(tasks)}
+        workers = min(self.workers, len(tasks))
+        settings = self.get_settings()
+        self.commands = [self.context.Queue() for _ in range(workers)]
+        self.spawned_at = [0.0] * workers
+        self.restarts = [0] * workers
+        self.processes = [self.spawn(shard, settings) for shard in range(workers)]
+        logger.info(
+            f"Monitoring {len(tasks)} target(s) with {workers} worker processes"
+        )
+
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="Coordinator"
+        ) as executor:
+            while not self.is_stop:
+                self.supervise(settings)
+                try:
+                    message = self.messages.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if message is None:
+                    continue
+                if message.candidates is not None:
+                    # in order on this thread, only the first target is staged
+                    self.set_candidates(message.candidates)
+                else:
+                    # in order on this thread, a restarted worker is seeded with it
+                    self.tasks[message.target].snapshot.apply(message.events)
+                    executor.submit(self.handle_message, message)
+
+        for command in self.commands:
+            command.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    def spawn(self, shard: int, settings: ShardSettings) -> multiprocessing.Process:
+        targets = list(range(shard, len(self.tasks), len(self.commands)))
+        # the cap is split by the number of targets
+        settings = dataclasses.replace(
+            settings,
+            requests_per_minute=settings.requests_per_minute
+            * len(targets)
+            / len(self.tasks),
+        )
+        process = self.context.Process(
+            target=run_shard,
+            args=(
+                shard,
+                targets,
+                # with the interval resolved, the workers know no default
+                [
+                    dataclasses.replace(
+                        self.tasks[i].shop_data,
+                        interval=self.tasks[i].scheduler.interval,
+                    )
+                    for i in targets
+                ],
+                self.messages,
+                self.commands[shard],
+                settings,
+                [list(self.tasks[i].snapshot.deliveries.values()) for i in targets],
+            ),
+            name=f"Shard_{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.spawned_at[shard] = time.time()
+        return process
+
+    def supervise(self, settings: ShardSettings, max_delay: float = 60):
+        """
+        Restart the workers that died, a worker that keeps dying soon after its start
+        waits twice as long every time, up to max_delay.
+        """
+        now = time.time()
+        for shard, process in enumerate(self.processes):
+            if self.is_stop or process.is_alive():
+                continue
+            if now - self.spawned_at[shard] >= max_delay:
+                self.restarts[shard] = 0
+            delay = min(2 ** self.restarts[shard], max_delay)
+            if now < self.spawned_at[shard] + delay:
+                continue
+            self.restarts[shard] += 1
+            logger.warning(
+                f"Worker process {shard} exited with code {process.exitcode}, restarting"
+            )
+            # a killed worker may still hold the reader lock of its queue
+            self.commands[shard] = self.context.Queue()
+            self.processes[shard] = self.spawn(shard, settings)
+
+    def set_candidates(self, candidates: list[DeliverySchema]):
+        if self.order_dispatcher and self.order_dispatcher.need_candidates():
+            self.order_dispatcher.set_candidates(candidates)
+
+    def handle_message(self, message: ShardMessage):
+        task = self.tasks[message.target]
+        try:
+            self.handle_events(task, message.events)
+        except Exception as e:
+            logging.exception(
+                f"Failed to handle the events of {task.shop_data.intro()} with error: ",
+                exc_info=e,
+            )
+
+    def handle_order_results(
+        self,
+        task: MonitorTask,
+        succeeded: list[str],
+        retry_events: list[InventoryEventSchema],
+    ):
+        if retry_events:
+            target = self.targets[id(task)]
+            self.commands[target % len(self.commands)].put(
+                ShardCommand(target, [i.key() for i in retry_events])
+            )
+        super().handle_order_results(task, succeeded, retry_events)
+
+    def stop(self):
+        super().stop()
+        # wake up the coordinator
+        self.messages.put(None)
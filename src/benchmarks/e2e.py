@@ -0,0 +1,98 @@
+"""
+End to end latency from stock appearing to the order being placed, against the local stand-in.
+
+Every run starts a fresh stand-in and InventoryMonitor with ordering enabled,
+the stand-in timeline splits the latency into detection, time slot, placing and confirming.
+
+    python -m benchmarks.e2e --runs 3 --stock-after 5 --delay checkoutx=0.05
+    python -m benchmarks.e2e --fixtures recorded/ --race-count 2 --stock-stores 2
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from actions.inventory_monitoring import InventoryMonitor
+from benchmarks.standin import StandinServer, add_config_arguments, get_config
+from common.schemas import OrderDeliverySchema, ShopSchema
+
+phases = [
+    ("detect", "stock_at", "stock_seen"),
+    ("time_slot", "stock_seen", "time_slot"),
+    ("place", "time_slot", "place_order"),
+    ("confirm", "place_order", "order_number"),
+    ("total", "stock_at", "order_number"),
+]
+
+
+def run_once(args: argparse.Namespace) -> dict[str, float]:
+    server = StandinServer(get_config(args)).start()
+    monitor = InventoryMonitor(host=server.url, order_host=server.url)
+    # a monitor that never orders is stopped, the run then has no total
+    timer = threading.Timer(args.stock_after + args.timeout, monitor.stop)
+    timer.start()
+    try:
+        monitor.start(
+            ShopSchema("cn", models=[args.model], location="standin", code="15-pro"),
+            order=True,
+            delivery_data=OrderDeliverySchema(
+                "Stand", "In", "standin@example.com", "10000000000", "0", "alipay"
+            ),
+            interval=args.interval,
+            order_race_count=args.race_count,
+            order_stage_interval=args.stage_interval,
+        )
+    except SystemExit:
+        pass
+    finally:
+        timer.cancel()
+        server.stop()
+
+    timeline = server.state.timeline | {"stock_at": server.state.stock_at}
+    return {
+        name: timeline[end] - timeline[start]
+        for name, start, end in phases
+        if start in timeline and end in timeline
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--model", type=str, default="MTQ83CH/A")
+    parser.add_argument("-i", "--interval", type=int, default=1)
+    parser.add_argument("--race-count", type=int, default=1)
+    parser.add_argument("--stage-interval", type=int, default=0)
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Seconds per run after the stock"
+    )
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    results = []
+    for idx in range(args.runs):
+        result = run_once(args)
+        results.append(result)
+        print(
+            f"run {idx + 1}: "
+            + ", ".join(
+                f"{name} {result.get(name, float('nan')) * 1000:.0f}ms"
+                for name, *_ in phases
+            )
+        )
+        time.sleep(0.5)
+
+    print(f"{'':10}{'min':>10}{'median':>10}{'max':>10}")
+    for name, *_ in phases:
+        values = [i[name] for i in results if name in i]
+        if not values:
+            print(f"{name:10}{'-':>10}{'-':>10}{'-':>10}")
+            continue
+        print(
+            f"{name:10}{min(values) * 1000:>8.0f}ms{statistics.median(values) * 1000:>8.0f}ms"
+            f"{max(values) * 1000:>8.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Pushes per second against a local stub webhook, one connection per push vs the pooled provider session.
+
+    python -m benchmarks.notifications -n 500
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from libs.notifications import DingTalkNotification
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real webhook endpoints
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        body = json.dumps({"errcode": 0, "code": 0}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(name: str, count: int, push) -> float:
+    start_time = time.perf_counter()
+    for _ in range(count):
+        push()
+    elapsed = time.perf_counter() - start_time
+    print(f"{name:12}{count / elapsed:>12.1f} pushes/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=500)
+    args = parser.parse_args()
+
+    server = start_server()
+    host = f"http://127.0.0.1:{server.server_port}"
+    payload = {"msgtype": "text", "text": {"content": "benchmark"}}
+
+    def push_without_session():
+        requests.post(f"{host}/robot/send?access_token=token", json=payload)
+
+    provider = DingTalkNotification("token", host=host)
+    run("no session", args.count, push_without_session)
+    run("pooled", args.count, lambda: provider.push_data("benchmark", ""))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Compare the regex based page extraction with libs.pages.extract_json.
+
+    python -m benchmarks.pages
+    python -m benchmarks.pages --product-page saved.html --checkout-page saved.html
+"""
+import argparse
+import json
+import re
+import timeit
+
+from libs.pages import extract_json
+from libs.products import parse_products
+
+init_data_marker = '<script id="init_data" type="application/json">'
+
+
+def build_product_page(products: int = 60, padding: int = 300 * 1024) -> str:
+    """A page with the size and layout of buy-iphone, the bootstrap near the end"""
+    select_data = {
+        "displayValues": {
+            "prices": {
+                f"price{i}": {
+                    "currentPrice": {
+                        "raw_amount": str(999 + i),
+                        "amount": f"${999 + i}",
+                    },
+                    "priceCurrency": "USD",
+                }
+                for i in range(products)
+            },
+            "dimensionColor": {
+                f"color{i}": {"value": f"Color {i}"} for i in range(products)
+            },
+        },
+        "products": [
+            {
+                "familyType": "iphone15pro",
+                "partNumber": f"MTV{i:02d}ZP/A",
+                "dimensionColor": f"color{i}",
+                "dimensionCapacity": f"{128 * (i % 4 + 1)}gb",
+                "fullPrice": f"price{i}",
+            }
+            for i in range(products)
+        ],
+    }
+    return (
+        "<html><head>"
+        + "<script>var noise = 1;</script>\n" * (padding // 32)
+        + "<script>window.PRODUCT_SELECTION_BOOTSTRAP = {\n    productSelectionData: "
+        + json.dumps(select_data)
+        + "\n}</script></head><body></body></html>"
+    )
+
+
+def build_checkout_page(padding: int = 200 * 1024) -> str:
+    meta = {
+        "meta": {"h": {"x-aos-stk": "token", "x-aos-model-page": "checkout"}},
+        "checkout": {"fulfillment": {"items": [{"id": i} for i in range(200)]}},
+    }
+    return (
+        "<html><head>"
+        + '<link rel="stylesheet" href="/x.css">\n' * (padding // 40)
+        + init_data_marker
+        + json.dumps(meta)
+        + "</script></head><body></body></html>"
+    )
+
+
+def regex_products(content: str):
+    select_match = re.search(
+        r"window.PRODUCT_SELECTION_BOOTSTRAP = (.+?)</script>", content, flags=re.DOTALL
+    )
+    select_text = (
+        select_match.group(1)
+        .strip()
+        .replace("productSelectionData", '"productSelectionData"')
+    )
+    return json.loads(select_text)["productSelectionData"]
+
+
+def extract_products(content: str):
+    return extract_json(
+        content, "window.PRODUCT_SELECTION_BOOTSTRAP", "productSelectionData", ":"
+    )
+
+
+def regex_checkout(content: str):
+    assert "x-aos-stk" in content
+    meta_match = re.search(
+        r"<script id=\"init_data\" type=\"application/json\">(.+?)</script>",
+        content,
+        flags=re.DOTALL,
+    )
+    return json.loads(meta_match.group(1).strip())
+
+
+def extract_checkout(content: str):
+    return extract_json(content, init_data_marker)
+
+
+def compare(name: str, content: str, old, new, number: int):
+    assert old(content) == new(content)
+    old_time = min(timeit.repeat(lambda: old(content), number=number, repeat=5))
+    new_time = min(timeit.repeat(lambda: new(content), number=number, repeat=5))
+    print(
+        f"{name:10}{len(content) // 1024:>8}KB"
+        f"{old_time / number * 1000:>12.3f}ms{new_time / number * 1000:>12.3f}ms"
+        f"{old_time / new_time:>9.1f}x"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--product-page", type=str, default="")
+    parser.add_argument("--checkout-page", type=str, default="")
+    parser.add_argument("-n", "--number", type=int, default=50)
+    args = parser.parse_args()
+
+    product_page = build_product_page()
+    if args.product_page:
+        with open(args.product_page, "r") as f:
+            product_page = f.read()
+    checkout_page = build_checkout_page()
+    if args.checkout_page:
+        with open(args.checkout_page, "r") as f:
+            checkout_page = f.read()
+
+    print(f"{'':10}{'size':>10}{'regex':>14}{'extract':>14}{'speedup':>10}")
+    compare("products", product_page, regex_products, extract_products, args.number)
+    compare("checkout", checkout_page, regex_checkout, extract_checkout, args.number)
+    assert parse_products(product_page)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Throughput and memory of the pure python parsers on the poll-to-decision path,
+with synthetic payloads scaled by stores, parts and page size.
+
+    python -m benchmarks.parsers
+    python -m benchmarks.parsers --stores 10 500 --parts 1 20 --json before.json
+    python -m benchmarks.parsers --compare before.json
+"""
+import argparse
+import functools
+import json
+import logging
+import platform
+import subprocess
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from actions.inventory_monitoring import InventoryMonitor, InventorySnapshot
+from actions.order import Order
+from benchmarks.pages import build_checkout_page, build_product_page
+from libs.notifications import NotificationDispatcher
+from libs.products import parse_products
+
+
+def build_fulfillment(stores: int, parts: int, available_ratio: float = 0.2) -> dict:
+    """A fulfillment-messages payload, every 1 / available_ratio store part available"""
+    step = max(int(1 / available_ratio), 1) if available_ratio else 0
+    store_list = []
+    for store in range(stores):
+        parts_availability = {}
+        for part in range(parts):
+            part_number = f"MTV{part:02d}ZP/A"
+            available = bool(step) and (store * parts + part) % step == 0
+            parts_availability[part_number] = {
+                "partNumber": part_number,
+                "pickupDisplay": "available" if available else "unavailable",
+                "pickupType": "In-Store Pickup",
+                "pickupSearchQuote": "Today" if available else "Unavailable",
+                "messageTypes": {
+                    "regular": {
+                        "storePickupProductTitle": f"iPhone\xa015\xa0Pro {part} 256GB"
+                    }
+                },
+            }
+        store_list.append(
+            {
+                "storeName": f"Store {store}",
+                "storeNumber": f"R{store:03d}",
+                "retailStore": {
+                    "address": {
+                        "state": "State",
+                        "city": "City",
+                        "district": "District",
+                    }
+                },
+                "partsAvailability": parts_availability,
+            }
+        )
+    return {"body": {"content": {"pickupMessage": {"stores": store_list}}}}
+
+
+def build_search_response(days: int = 7, windows: int = 12) -> dict:
+    """Time slots where only the last window of the last day is open, the worst case"""
+    time_slot_windows = []
+    for day in range(days):
+        time_slot_windows.append(
+            {
+                f"day{day}": [
+                    {
+                        "isRestricted": day != days - 1 or window != windows - 1,
+                        "checkInStart": f"{9 + window // 4}:{window % 4 * 15:02d}",
+                        "checkInEnd": f"{9 + window // 4}:{window % 4 * 15 + 15:02d}",
+                        "SlotId": f"slot-{day}-{window}",
+                        "signKey": "sign",
+                        "timeZone": "Asia/Shanghai",
+                        "timeSlotValue": f"{day}-{window}",
+                        "Label": f"Window {window}",
+                    }
+                    for window in range(windows)
+                ]
+            }
+        )
+    return {
+        "body": {
+            "checkout": {
+                "fulfillment": {
+                    "pickupTab": {
+                        "pickup": {
+                            "timeSlot": {
+                                "dateTimeSlots": {
+                                    "d": {
+                                        "timeSlotWindows": time_slot_windows,
+                                        "pickUpDates": [
+                                            {
+                                                "date": f"2023-10-{day + 1:02d}",
+                                                "dayOfWeek": "Mon",
+                                            }
+                                            for day in range(days)
+                                        ],
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+class PageResponse(object):
+    status_code = 200
+
+    def __init__(self, text: str) -> None:
+        super().__init__()
+        self.text = text
+
+
+class PageSession(object):
+    """Answers every get with the same page, only the parsing is measured"""
+
+    def __init__(self, text: str) -> None:
+        super().__init__()
+        self.response = PageResponse(text)
+        # Order updates the headers of the underlying requests session
+        self.session = self
+        self.headers = {}
+
+    def get(self, *args, **kwargs) -> PageResponse:
+        return self.response
+
+
+class ParseMonitor(InventoryMonitor):
+    """Only parses, without the threads of the notifier"""
+
+    notifier_class = functools.partial(NotificationDispatcher, workers=0)
+
+
+def get_cases(args: argparse.Namespace) -> dict[str, Callable[[], object]]:
+    monitor = ParseMonitor(max_workers=1)
+    cases = {}
+    for stores in args.stores:
+        for parts in args.parts:
+            data = build_fulfillment(stores, parts)
+            cases[
+                f"parse_data/{stores}x{parts}"
+            ] = lambda data=data: monitor.parse_data(data)
+            cases[
+                f"parse_data_available/{stores}x{parts}"
+            ] = lambda data=data: monitor.parse_data(data, statuses={"available"})
+            snapshot = InventorySnapshot()
+            snapshot.update(monitor.parse_data(data, statuses={"available"}))
+
+            def decide(data=data, snapshot=snapshot):
+                # a steady poll, parsed lazily straight into the snapshot
+                return snapshot.update(monitor.iter_data(data, statuses={"available"}))
+
+            cases[f"snapshot_update/{stores}x{parts}"] = decide
+
+    for products in args.products:
+        page = build_product_page(products=products)
+        cases[f"parse_products/{products}"] = lambda page=page: parse_products(page)
+
+    order = Order("cn")
+    order.session = PageSession(build_checkout_page())
+    cases["get_page_with_meta"] = lambda: order.get_page_with_meta(
+        "/shop/checkout", None
+    )
+
+    for days in args.days:
+        search_data = build_search_response(days=days)
+        cases[
+            f"get_select_window/{days}d"
+        ] = lambda search_data=search_data: order.get_select_window(search_data)
+    return cases
+
+
+def measure(func: Callable[[], object], min_time: float) -> dict:
+    # the parsers log every call, the handlers would be measured as well
+    logging.disable(logging.INFO)
+    try:
+        return measure_quietly(func, min_time)
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def measure_quietly(func: Callable[[], object], min_time: float) -> dict:
+    func()
+    number = 0
+    start_time = time.perf_counter()
+    elapsed = 0.0
+    # grow the batch until it runs long enough to trust the clock
+    batch = 1
+    while elapsed < min_time:
+        for _ in range(batch):
+            func()
+        number += batch
+        batch *= 2
+        elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # blocks still held by the result, the peak covers the temporary ones
+    retained = sum(
+        i.count_diff for i in after.compare_to(before, "filename") if i.count_diff > 0
+    )
+    del result
+    return {
+        "ops": number / elapsed,
+        "us_per_op": elapsed / number * 1e6,
+        "peak_kb": peak / 1024,
+        "retained_blocks": retained,
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_results(results: dict[str, dict], baseline: Optional[dict[str, dict]] = None):
+    header = f"{'case':36}{'ops/s':>12}{'us/op':>10}{'peak kb':>10}{'retained':>10}"
+    if baseline:
+        header += f"{'ops/s diff':>12}{'retained diff':>15}"
+    print(header)
+    for name, data in results.items():
+        line = (
+            f"{name:36}{data['ops']:>12.0f}{data['us_per_op']:>10.1f}"
+            f"{data['peak_kb']:>10.1f}{data['retained_blocks']:>10}"
+        )
+        base = (baseline or {}).get(name)
+        if base:
+            line += (
+                f"{(data['ops'] / base['ops'] - 1) * 100:>+11.1f}%"
+                f"{data['retained_blocks'] - base['retained_blocks']:>+15}"
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stores", nargs="+", type=int, default=[10, 50, 200, 500])
+    parser.add_argument("--parts", nargs="+", type=int, default=[1, 5, 20])
+    parser.add_argument("--products", nargs="+", type=int, default=[20, 60, 200])
+    parser.add_argument("--days", nargs="+", type=int, default=[1, 7, 14])
+    parser.add_argument(
+        "-k", "--filter", type=str, default="", help="Only cases containing this"
+    )
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds per case")
+    parser.add_argument(
+        "--json", type=str, default="", help="Save the results to this file"
+    )
+    parser.add_argument(
+        "--compare", type=str, default="", help="Results file of a previous run"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in get_cases(args).items():
+        if args.filter in name:
+            results[name] = measure(func, args.min_time)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compared = json.load(f)
+        baseline = compared["results"]
+        print(f"Compared with {compared.get('commit') or args.compare}")
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "commit": get_commit(),
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
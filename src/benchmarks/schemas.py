@@ -0,0 +1,90 @@
+"""
+Compare allocations and RSS of the slotted schemas against plain dataclasses.
+
+    python -m benchmarks.schemas -n 100000
+"""
+import argparse
+import dataclasses
+import multiprocessing
+import resource
+import sys
+import tracemalloc
+
+from common.schemas import DeliverySchema
+
+
+def plain_dataclass(cls):
+    """The same schema as a plain dataclass with a per-instance __dict__"""
+    return dataclasses.make_dataclass(
+        "Plain" + cls.__name__,
+        [(i.name, i.type) for i in dataclasses.fields(cls)],
+    )
+
+
+def build(cls, count: int, intern: bool) -> list:
+    wrap = sys.intern if intern else str
+    items = []
+    for idx in range(count):
+        store = idx % 500
+        items.append(
+            cls(
+                state="State",
+                city="City",
+                district="District",
+                store_name=wrap(f"Store {store}"),
+                store_number=wrap(f"R{store:03d}"),
+                model_name=wrap(f"iPhone 15 Pro {idx % 20} 256GB"),
+                pickup_quote=f"Today {idx % 7}",
+                model=wrap(f"MTV{idx % 20:02d}ZP/A"),
+                status=wrap("available" if idx % 3 else "ineligible"),
+                pickup_type=wrap("In-Store Pickup"),
+            )
+        )
+    return items
+
+
+def measure(name: str, count: int, result: dict):
+    cls = DeliverySchema if name == "slotted" else plain_dataclass(DeliverySchema)
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    items = build(cls, count, intern=name == "slotted")
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result[name] = {
+        "allocations": sum(i.count for i in snapshot.statistics("filename")),
+        "bytes": current,
+        "peak_bytes": peak,
+        "rss_kb": rss_end - rss_start,
+    }
+    del items
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    with multiprocessing.Manager() as manager:
+        result = manager.dict()
+        # every variant runs in a fresh process so RSS is not shared
+        for name in ["plain", "slotted"]:
+            process = multiprocessing.Process(
+                target=measure, args=(name, args.count, result)
+            )
+            process.start()
+            process.join()
+        result = dict(result)
+
+    print(f"{args.count} DeliverySchema instances")
+    print(f"{'':10}{'allocations':>14}{'bytes':>14}{'peak bytes':>14}{'rss kb':>10}")
+    for name, data in result.items():
+        print(
+            f"{name:10}{data['allocations']:>14}{data['bytes']:>14}"
+            f"{data['peak_bytes']:>14}{data['rss_kb']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""
+A local stand-in of the Apple Store, for benchmarks that must not touch apple.com.
+
+It answers fulfillment-messages and the whole order flow (bag, signIn, checkoutx, statusX),
+stock appears after a delay and every endpoint can be slowed down. Fixtures saved with
+main.py --record replace the synthetic responses, with the stock state applied on top.
+
+    python -m benchmarks.standin --port 8080 --stock-after 10 --delay checkoutx=0.2
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse, parse_qsl
+
+from libs.recorder import get_fixture_key, load_fixtures
+
+init_data_marker = '<script id="init_data" type="application/json">'
+
+apple_host_pattern = re.compile(r"https?:(\\?/){2}[\w.-]*apple\.com(\.cn)?")
+
+
+@dataclasses.dataclass()
+class StandinConfig(object):
+    stores: int = 5
+    # seconds after the server starts before stock shows up, and for how long
+    stock_after: float = 5
+    stock_duration: float = 0
+    stock_stores: int = 1
+    # placeOrder and statusX are pending for this many polls
+    place_order_polls: int = 1
+    status_polls: int = 2
+    # seconds per endpoint or checkout action, "default" for the others
+    delays: dict[str, float] = dataclasses.field(default_factory=dict)
+    fixtures: str = ""
+
+
+class StandinState(object):
+    def __init__(self, config: StandinConfig) -> None:
+        super().__init__()
+        self.config = config
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        # session id -> pending polls of the checkout
+        self.sessions: dict[str, dict] = {}
+        self.order_numbers = itertools.count(1)
+        # first time of every milestone, seconds since the epoch
+        self.timeline: dict[str, float] = {}
+        self.fixtures = load_fixtures(config.fixtures) if config.fixtures else {}
+        # the first stock_stores of these get the stock
+        self.store_numbers = [f"R{i:03d}" for i in range(config.stores)]
+
+    @property
+    def stock_at(self) -> float:
+        return self.started_at + self.config.stock_after
+
+    def has_stock(self, store_number: str) -> bool:
+        now = time.time()
+        if store_number not in self.store_numbers[: self.config.stock_stores]:
+            return False
+        if now < self.stock_at:
+            return False
+        return (
+            not self.config.stock_duration
+            or now < self.stock_at + self.config.stock_duration
+        )
+
+    def mark(self, milestone: str):
+        with self.lock:
+            self.timeline.setdefault(milestone, time.time())
+
+    def get_session(self, session_id: str) -> dict:
+        with self.lock:
+            return self.sessions.setdefault(
+                session_id,
+                {
+                    "place_order_polls": self.config.place_order_polls,
+                    "status_polls": self.config.status_polls,
+                    "order_number": "",
+                },
+            )
+
+    def get_delay(self, endpoint: str, action: str) -> float:
+        delays = self.config.delays
+        return delays.get(action, delays.get(endpoint, delays.get("default", 0)))
+
+
+def build_page(data: dict) -> str:
+    return f"<html><head>{init_data_marker}{json.dumps(data)}</script></head><body></body></html>"
+
+
+def build_meta() -> dict:
+    return {
+        "meta": {"h": {"x-aos-stk": uuid.uuid4().hex, "x-aos-model-page": "checkout"}}
+    }
+
+
+def build_time_slot() -> dict:
+    day = time.strftime("%Y-%m-%d")
+    return {
+        "dateTimeSlots": {
+            "d": {
+                "timeSlotWindows": [
+                    {
+                        day: [
+                            {
+                                "isRestricted": False,
+                                "checkInStart": "10:00",
+                                "checkInEnd": "10:15",
+                                "SlotId": "slot-1",
+                                "signKey": "sign",
+                                "timeZone": "Asia/Shanghai",
+                                "timeSlotValue": "10:00-10:15",
+                                "Label": "10:00 - 10:15",
+                            }
+                        ]
+                    }
+                ],
+                "pickUpDates": [{"date": day, "dayOfWeek": time.strftime("%a")}],
+                "displayStartTime": "10:00",
+                "displayEndTime": "10:15",
+                "isRecommended": True,
+                "isRestricted": False,
+                "dayRadio": "0",
+            }
+        }
+    }
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    state: StandinState
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.headers.get('Host')}"
+
+    def do_GET(self):
+        self.form = {}
+        self.handle_request()
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.form = dict(parse_qsl(content.decode()))
+        self.handle_request()
+
+    def handle_request(self):
+        url_parsed = urlparse(self.path)
+        path = url_parsed.path
+        params = dict(parse_qsl(url_parsed.query))
+        action = params.get("_a", "")
+        endpoint = self.get_endpoint(path)
+        delay = self.state.get_delay(endpoint, action)
+        delay and time.sleep(delay)
+
+        cookies = {}
+        session_id = self.get_cookie("standin_session")
+        if endpoint == "atb":
+            session_id = uuid.uuid4().hex
+            cookies = {
+                "as_atb": f"1.0|standin|{session_id[:8]}",
+                "standin_session": session_id,
+            }
+        session = self.state.get_session(session_id or "")
+
+        body = getattr(self, f"handle_{endpoint}")(params, session)
+        if isinstance(body, dict):
+            body = self.apply_fixture(path, action, body)
+            self.send_body(json.dumps(body), "application/json", cookies)
+        else:
+            # the interstitial carries the order number, it is always the stand-in's
+            if endpoint != "interstitial":
+                body = self.get_fixture_body(path, action) or body
+            self.send_body(body, "text/html", cookies)
+
+    @staticmethod
+    def get_endpoint(path: str) -> str:
+        for pattern, endpoint in [
+            ("/fulfillment-messages", "fulfillment"),
+            ("/shop/beacon/atb", "atb"),
+            ("/shop/buy-", "product"),
+            ("/shop/bagx", "checkout_now"),
+            ("/shop/bag", "bag"),
+            ("/shop/signInx", "signin"),
+            ("/shop/signIn", "signin_page"),
+            ("/shop/checkout/start", "checkout_start"),
+            ("/shop/checkout/interstitial", "interstitial"),
+            ("/shop/checkoutx/statusX", "status"),
+            ("/shop/checkoutx", "checkoutx"),
+            ("/shop/checkout", "checkout_page"),
+        ]:
+            if pattern in path:
+                return endpoint
+        return "not_found"
+
+    def get_cookie(self, name: str) -> Optional[str]:
+        for item in (self.headers.get("Cookie") or "").split(";"):
+            key, _, value = item.strip().partition("=")
+            if key == name:
+                return value
+        return None
+
+    def send_body(self, body: str, content_type: str, cookies: dict, status: int = 200):
+        content = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in cookies.items():
+            self.send_header("Set-Cookie", f"{key}={value}; Path=/")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def apply_fixture(self, path: str, action: str, body: dict) -> dict:
+        """
+        A recorded body in place of the synthetic one, the fields the synthetic body
+        holds (stock, statuses, urls, order number) still come from the stand-in.
+        """
+        return merge(self.get_fixture_json(path, action) or {}, body)
+
+    def get_fixture_json(self, path: str, action: str) -> Optional[dict]:
+        text = self.get_fixture_body(path, action)
+        if not text:
+            return None
+        try:
+            recorded = json.loads(text)
+        except ValueError:
+            return None
+        return recorded if isinstance(recorded, dict) else None
+
+    def get_fixture_body(self, path: str, action: str) -> Optional[str]:
+        fixture = self.state.fixtures.get(
+            get_fixture_key(self.command, f"{path}?_a={action}")
+        )
+        if not fixture:
+            return None
+        return apple_host_pattern.sub(self.base_url, fixture["body"])
+
+    def handle_not_found(self, params: dict, session: dict):
+        return {"head": {"status": 404}}
+
+    def handle_fulfillment(self, params: dict, session: dict):
+        recorded = self.get_fixture_json(urlparse(self.path).path, "")
+        if recorded:
+            return self.replay_fulfillment(recorded)
+        parts = [v for k, v in params.items() if k.startswith("parts.")]
+        stores = []
+        has_stock = False
+        for idx, store_number in enumerate(self.state.store_numbers):
+            available = self.state.has_stock(store_number)
+            has_stock = has_stock or available
+            stores.append(
+                {
+                    "storeName": f"Stand-in {idx}",
+                    "storeNumber": store_number,
+                    "retailStore": {
+                        "address": {
+                            "state": "State",
+                            "city": "City",
+                            "district": "District",
+                        }
+                    },
+                    "partsAvailability": {
+                        part: {
+                            "partNumber": part,
+                            "pickupDisplay": "available"
+                            if available
+                            else "unavailable",
+                            "pickupType": "In-Store Pickup",
+                            "pickupSearchQuote": "Today"
+                            if available
+                            else "Unavailable",
+                            "messageTypes": {
+                                "regular": {
+                                    "storePickupProductTitle": f"Stand-in {part}"
+                                }
+                            },
+                        }
+                        for part in parts
+                    },
+                }
+            )
+        if has_stock:
+            self.state.mark("stock_seen")
+        return {"body": {"content": {"pickupMessage": {"stores": stores}}}}
+
+    def replay_fulfillment(self, recorded: dict) -> dict:
+        """The recorded stores and parts, with the stock of the stand-in"""
+        stores = recorded["body"]["content"]["pickupMessage"].get("stores") or []
+        with self.state.lock:
+            self.state.store_numbers = [i["storeNumber"] for i in stores]
+        has_stock = False
+        for store in stores:
+            available = self.state.has_stock(store["storeNumber"])
+            has_stock = has_stock or available
+            for part in store["partsAvailability"].values():
+                part["pickupDisplay"] = "available" if available else "unavailable"
+                part["pickupSearchQuote"] = "Today" if available else "Unavailable"
+        if has_stock:
+            self.state.mark("stock_seen")
+        return recorded
+
+    def handle_atb(self, params: dict, session: dict):
+        return {"head": {"status": 200}}
+
+    def handle_product(self, params: dict, session: dict):
+        return "<html></html>"
+
+    def handle_bag(self, params: dict, session: dict):
+        return build_page(build_meta() | {"shoppingCart": {"items": {"c": ["item-0"]}}})
+
+    def handle_checkout_now(self, params: dict, session: dict):
+        return {
+            "head": {
+                "status": 302,
+                "data": {"url": f"{self.base_url}/shop/signIn?ssi=standin"},
+            }
+        }
+
+    def handle_signin_page(self, params: dict, session: dict):
+        return build_page(build_meta())
+
+    def handle_signin(self, params: dict, session: dict):
+        return {
+            "head": {
+                "status": 302,
+                "data": {
+                    "url": f"{self.base_url}/shop/checkout/start",
+                    "args": {"pltn": "standin"},
+                },
+            }
+        }
+
+    def handle_checkout_start(self, params: dict, session: dict):
+        return {
+            "head": {"status": 302, "data": {"url": f"{self.base_url}/shop/checkout"}}
+        }
+
+    def handle_checkout_page(self, params: dict, session: dict):
+        return build_page(build_meta())
+
+    def handle_checkoutx(self, params: dict, session: dict):
+        action = params.get("_a", "")
+        if action == "search":
+            pickup = {}
+            store_number = self.form.get(
+                "checkout.fulfillment.pickupTab.pickup.storeLocator.selectStore", ""
+            )
+            if self.state.has_stock(store_number):
+                pickup["timeSlot"] = build_time_slot()
+                self.state.mark("time_slot")
+            else:
+                # dropped from a recorded body too
+                pickup["timeSlot"] = None
+            return {
+                "head": {"status": 200},
+                "body": {
+                    "checkout": {"fulfillment": {"pickupTab": {"pickup": pickup}}}
+                },
+            }
+        if action == "continueFromReviewToProcess":
+            with self.state.lock:
+                session["place_order_polls"] -= 1
+                pending = session["place_order_polls"] >= 0
+            if pending:
+                return {"head": {"status": 200}}
+            self.state.mark("place_order")
+            return {
+                "head": {
+                    "status": 302,
+                    "data": {"url": "/shop/checkout/interstitial"},
+                }
+            }
+        return {"head": {"status": 200}}
+
+    def handle_status(self, params: dict, session: dict):
+        with self.state.lock:
+            session["status_polls"] -= 1
+            pending = session["status_polls"] >= 0
+            if not pending and not session["order_number"]:
+                session["order_number"] = f"W{next(self.state.order_numbers):09d}"
+        if pending:
+            return {"head": {"status": 200}}
+        return {"head": {"status": 302, "data": {"url": "/shop/checkout/interstitial"}}}
+
+    def handle_interstitial(self, params: dict, session: dict):
+        data = build_meta()
+        if session["order_number"]:
+            self.state.mark("order_number")
+            data["thankYouInterstitial"] = {
+                "d": {"orderNumber": session["order_number"]}
+            }
+        return build_page(data)
+
+
+def merge(recorded: dict, synthetic: dict) -> dict:
+    """The synthetic values win, a None removes the key"""
+    merged = dict(recorded)
+    for key, value in synthetic.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict):
+            merged[key] = merge(
+                merged[key] if isinstance(merged.get(key), dict) else {}, value
+            )
+        else:
+            merged[key] = value
+    return merged
+
+
+class StandinServer(object):
+    def __init__(self, config: Optional[StandinConfig] = None, port: int = 0) -> None:
+        super().__init__()
+        self.config = config or StandinConfig()
+        self.state = StandinState(self.config)
+        handler = type("Handler", (StandinHandler,), {"state": self.state})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "StandinServer":
+        self.state.started_at = time.time()
+        threading.Thread(
+            target=self.server.serve_forever, name="Standin", daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def parse_delays(items: list[str]) -> dict[str, float]:
+    delays = {}
+    for item in items:
+        name, _, seconds = item.partition("=")
+        delays[name] = float(seconds)
+    return delays
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--stores", type=int, default=5)
+    parser.add_argument("--stock-after", type=float, default=5)
+    parser.add_argument("--stock-duration", type=float, default=0)
+    parser.add_argument("--stock-stores", type=int, default=1)
+    parser.add_argument("--place-order-polls", type=int, default=1)
+    parser.add_argument("--status-polls", type=int, default=2)
+    parser.add_argument(
+        "--delay",
+        nargs="+",
+        default=[],
+        help="endpoint=seconds, e.g. checkoutx=0.2 search=1",
+    )
+    parser.add_argument(
+        "--fixtures", type=str, default="", help="Directory of main.py --record"
+    )
+
+
+def get_config(args: argparse.Namespace) -> StandinConfig:
+    return StandinConfig(
+        stores=args.stores,
+        stock_after=args.stock_after,
+        stock_duration=args.stock_duration,
+        stock_stores=args.stock_stores,
+        place_order_polls=args.place_order_polls,
+        status_polls=args.status_polls,
+        delays=parse_delays(args.delay),
+        fixtures=args.fixtures,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = StandinServer(get_config(args), port=args.port).start()
+    print(f"Stand-in serving on {server.url}, stock after {args.stock_after}s")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,27 @@ class ShopSchema(object):
     state: str = ""
     code: str = ""
     store_filters: list[str] = dataclasses.field(default_factory=lambda: [])
+    # query interval of this target, 0 means the monitor default
+    interval: int = 0
 
+    def intro(self) -> str:
+        return " ".join(
+            [
+                i
+                for i in [self.country, self.location, self.postal_code, self.state]
+                if i
+            ]
+        )
 
-@dataclasses.dataclass()
+    def key(self) -> str:
+        """Tells the targets apart, the same as before for targets without store filters"""
+        key = f"{self.intro()} {','.join(self.models)}"
+        if self.store_filters:
+            key += f" {','.join(self.store_filters)}"
+        return key
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class DeliverySchema(object):
     state: str
     city: str
@@ -37,7 +55,25 @@ class DeliverySchema(object):
         )
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(frozen=True, slots=True)
+class InventoryEventSchema(object):
+    type: str
+    delivery: DeliverySchema
+    previous: Optional[DeliverySchema] = None
+
+    def key(self) -> tuple[str, str]:
+        return self.delivery.store_number, self.delivery.model
+
+    def intro(self) -> str:
+        if self.delivery is self.previous:
+            # missing from the latest query, the pickup quote is outdated
+            return (
+                f"[{self.type}] {self.delivery.store_name} {self.delivery.model_name}"
+            )
+        return f"[{self.type}] {self.delivery.intro()}"
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class ProductSchema(object):
     model: str
     type: str
@@ -68,7 +104,7 @@ class ProductSchema(object):
         return " ".join(buffers)
 
 
-@dataclasses.dataclass()
+@dataclasses.dataclass(slots=True)
 class PaymentSchema(object):
     label: str
     key: str
@@ -97,6 +133,18 @@ class OrderDeliverySchema(object):
     payment_number: int = 0
 
 
+@dataclasses.dataclass()
+class WishSchema(object):
+    model: str
+    model_code: str
+    # key of the buyer's OrderDeliverySchema
+    buyer: str
+    # lower goes first
+    priority: int = 0
+    ac_type: str = ""
+    ac_model: str = ""
+
+
 @dataclasses.dataclass()
 class OrderSchema(object):
     model: str
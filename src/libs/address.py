@@ -1,26 +1,157 @@
-import requests
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
 
+from libs.cache import FileCache
+from libs.requests import Request
 
-def get_address(country: str, filter_str: str = ""):
-    default_headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/117.0",
-    }
-    filters = filter_str.split(" ")
+logger = logging.getLogger(__name__)
+
+address_cache = FileCache("address")
+
+# state -> city -> district, a list holds the value of a leaf lookup
+AddressTree = dict[str, Union["AddressTree", list[str]]]
+
+address_levels = ["state", "city", "district"]
+
+
+def fetch_address(
+    country: str, filters: list[str], session: Optional[Request] = None
+) -> Union[dict, list[str]]:
+    """One level of /shop/address-lookup, a dict of children or the leaf value"""
+    session = session or Request("https://www.apple.com")
     params = {
-        "state": filters[0] if len(filters) > 0 else None,
-        "city": filters[1] if len(filters) > 1 else None,
-        "district": filters[2] if len(filters) > 2 else None,
+        level: filters[idx] if len(filters) > idx else None
+        for idx, level in enumerate(address_levels)
     }
-    resp = requests.get(
-        f"https://www.apple.com/{country}/shop/address-lookup",
-        params=params,
-        headers=default_headers,
-    )
+    resp = session.get(f"/{country}/shop/address-lookup", params=params)
     resp_json = resp.json()
     assert resp_json["head"]["status"] == "200"
     address_data = resp_json["body"].popitem()[1]
     if isinstance(address_data, dict):
-        addresses = [i["value"] for i in address_data["data"]]
-    else:
-        addresses = [address_data]
-    return addresses
+        return {i["value"]: {} for i in address_data["data"]}
+    return [address_data]
+
+
+class AddressIndex(object):
+    """The whole address hierarchy of a country, crawled once and answered from memory"""
+
+    indexes: dict[str, "AddressIndex"] = {}
+
+    def __init__(self, country: str, tree: AddressTree) -> None:
+        super().__init__()
+        self.country = country
+        self.tree = tree
+        self.session: Optional[Request] = None
+
+    @classmethod
+    def get(
+        cls,
+        country: str,
+        ttl: int = 60 * 60 * 24 * 30,
+        offline: bool = False,
+        cache: FileCache = address_cache,
+    ) -> "AddressIndex":
+        if country in cls.indexes:
+            return cls.indexes[country]
+        entry = cache.get(country)
+        if entry and (offline or entry.is_fresh(ttl)):
+            index = cls(country, entry.data)
+        else:
+            assert not offline, f"No cached address of {country}"
+            index = cls.build(country)
+            cache.set(country, index.tree)
+        cls.indexes[country] = index
+        return index
+
+    @classmethod
+    def build(cls, country: str, max_workers: int = 8) -> "AddressIndex":
+        logger.info(f"Building address index of {country}...")
+        index = cls(country, {})
+        index.session = Request("https://www.apple.com", pool_size=max_workers)
+        tree = index.fetch([])
+        assert isinstance(tree, dict), f"No address of {country}"
+        index.tree = tree
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # crawl level by level, every level is fetched concurrently
+            nodes = [([name], tree) for name in tree]
+            while nodes:
+                futures = [
+                    (path, parent, executor.submit(index.fetch, path))
+                    for path, parent in nodes
+                ]
+                nodes = []
+                for path, parent, future in futures:
+                    children = future.result()
+                    # a failed node stays empty, a lookup reaching it fetches it again
+                    if children is None:
+                        continue
+                    parent[path[-1]] = children
+                    # districts are the last level, their leaf values are not crawled
+                    if (
+                        isinstance(children, dict)
+                        and len(path) < len(address_levels) - 1
+                    ):
+                        nodes.extend((path + [name], children) for name in children)
+        return index
+
+    def fetch(
+        self, path: list[str], retries: int = 2
+    ) -> Optional[Union[AddressTree, list[str]]]:
+        """The children of path, None when every attempt failed"""
+        if not self.session:
+            self.session = Request("https://www.apple.com")
+        for attempt in range(retries + 1):
+            try:
+                return fetch_address(self.country, path, session=self.session)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to fetch address {' '.join(path)}, attempt {attempt + 1}: {e}"
+                )
+        return None
+
+    def expand(
+        self, parent: AddressTree, path: list[str], offline: bool = False
+    ) -> Union[AddressTree, list[str]]:
+        """The node of path, a district or failed node is fetched on first use"""
+        node = parent[path[-1]]
+        if node == {} and not offline:
+            children = self.fetch(path)
+            if children is not None:
+                node = parent[path[-1]] = children
+        return node
+
+    def lookup(self, filter_str: str = "", offline: bool = False) -> list[str]:
+        """
+        Children of the filtered node, every filter matches exactly,
+        or else by prefix, or else as a substring.
+        """
+        nodes: list[tuple[list[str], Union[AddressTree, list[str]]]] = [([], self.tree)]
+        for name in filter_str.split():
+            matched = []
+            for path, node in nodes:
+                if isinstance(node, dict):
+                    matched.extend(
+                        (path + [i], self.expand(node, path + [i], offline))
+                        for i in self.match(node, name)
+                    )
+            nodes = matched
+
+        addresses = []
+        for _, node in nodes:
+            for address in node:
+                if address not in addresses:
+                    addresses.append(address)
+        return addresses
+
+    @staticmethod
+    def match(node: AddressTree, name: str) -> list[str]:
+        if name in node:
+            return [name]
+        return [i for i in node if i.startswith(name)] or [i for i in node if name in i]
+
+
+def get_address(country: str, filter_str: str = "", offline: bool = False):
+    return AddressIndex.get(country, offline=offline).lookup(
+        filter_str, offline=offline
+    )
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Optional, Union
+from urllib.parse import urlparse
+
+import requests
+
+from libs.requests import LatencyWindow, Request, hedged_total
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse(object):
+    """The parts of requests.Response the callers use, read completely"""
+
+    def __init__(
+        self, status_code: int, url: str, headers, text: str, cookies: dict
+    ) -> None:
+        super().__init__()
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.text = text
+        self.cookies = cookies
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            # the scheduler reads Retry-After from error.response like with requests
+            raise requests.HTTPError(
+                f"{self.status_code} Error for url: {self.url}", response=self
+            )
+
+
+class AsyncRequest(object):
+    """
+    The asyncio counterpart of libs.requests.Request on aiohttp, same timeouts,
+    GET retries and hedging, so hundreds of queries share one event loop.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        headers: Optional[dict] = None,
+        timeout: float = 5,
+        pool_size: int = 100,
+        connect_timeout: float = 3.05,
+        retries: int = 2,
+        hedge_percentile: float = 0.95,
+        hedge_min_delay: float = 0.1,
+        hedge_max_delay: float = 2,
+        hedge_min_samples: int = 20,
+    ) -> None:
+        super().__init__()
+        assert aiohttp, "aiohttp is required for asyncio, pip install aiohttp"
+        self.request_host = host
+        self.headers = dict(Request.default_headers) | (headers or {})
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies: dict[str, LatencyWindow] = {}
+        # created on first use, it belongs to the running loop
+        self.session: Optional["aiohttp.ClientSession"] = None
+
+    def get_session(self) -> "aiohttp.ClientSession":
+        if not self.session:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                # stand-in servers are addressed by ip
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+            )
+        return self.session
+
+    async def warm(self, host: Optional[str] = None, count: int = 1) -> int:
+        """Open up to count keep-alive connections, returns the number of successful ones"""
+        url = (host or self.request_host).rstrip("/") + "/"
+
+        async def head():
+            try:
+                await self.request("HEAD", url, allow_redirects=False)
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.debug(f"Warming {url} failed: {e!r}")
+                return False
+
+        count = max(min(count, self.pool_size), 1)
+        return sum(await asyncio.gather(*(head() for _ in range(count))))
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def get_timeout(
+        self, timeout: Union[float, tuple[float, float], None]
+    ) -> "aiohttp.ClientTimeout":
+        if timeout is None:
+            connect, read = self.connect_timeout, self.timeout
+        elif isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect, read = self.connect_timeout, timeout
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        timeout: Union[float, tuple[float, float], None] = None,
+        **kwargs,
+    ) -> AsyncResponse:
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        # only idempotent requests are retried, like the urllib3 Retry of Request
+        retries = self.retries if method in ("GET", "HEAD") else 0
+        for attempt in range(retries + 1):
+            try:
+                async with self.get_session().request(
+                    method, url, timeout=self.get_timeout(timeout), **kwargs
+                ) as resp:
+                    return AsyncResponse(
+                        resp.status,
+                        str(resp.url),
+                        resp.headers,
+                        await resp.text(),
+                        {k: v.value for k, v in resp.cookies.items()},
+                    )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= retries:
+                    raise
+                logger.debug(f"Retrying {method} {url} after {e!r}")
+                await asyncio.sleep(0.1 * 2**attempt)
+
+    async def get(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        timeout: Union[float, tuple[float, float], None] = None,
+        hedge: bool = False,
+    ) -> AsyncResponse:
+        kwargs = dict(params=params, headers=headers, timeout=timeout)
+        if hedge and Request.hedging:
+            return await self.hedged_request("GET", self.get_url(path), **kwargs)
+        return await self.request("GET", self.get_url(path), **kwargs)
+
+    async def post(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        data: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        fetch_header: bool = True,
+        json: Optional[dict] = None,
+        timeout: Union[float, tuple[float, float], None] = None,
+    ) -> AsyncResponse:
+        if fetch_header:
+            headers = (headers or {}) | {"X-Requested-With": "Fetch"}
+        return await self.request(
+            "POST",
+            self.get_url(path),
+            params=params,
+            data=data,
+            headers=headers,
+            json=json,
+            timeout=timeout,
+        )
+
+    def get_url(self, path: str):
+        if path.startswith("http"):
+            return path
+        return self.request_host + path
+
+    def get_hedge_delay(self, window: LatencyWindow) -> float:
+        if len(window) < self.hedge_min_samples:
+            return self.hedge_max_delay
+        delay = window.percentile(self.hedge_percentile)
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    async def timed_request(
+        self, window: LatencyWindow, method: str, url: str, **kwargs
+    ):
+        start_time = time.perf_counter()
+        resp = await self.request(method, url, **kwargs)
+        window.add(time.perf_counter() - start_time)
+        return resp
+
+    async def hedged_request(self, method: str, url: str, **kwargs) -> AsyncResponse:
+        """Only for idempotent requests, the slower attempt is cancelled"""
+        window = self.latencies.setdefault(urlparse(url).path, LatencyWindow())
+        primary = asyncio.create_task(self.timed_request(window, method, url, **kwargs))
+        done, _ = await asyncio.wait([primary], timeout=self.get_hedge_delay(window))
+        if done:
+            return primary.result()
+
+        hedge = asyncio.create_task(self.timed_request(window, method, url, **kwargs))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        hedged_total.inc(
+                            winner="primary" if task is primary else "hedge"
+                        )
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
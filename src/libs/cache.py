@@ -0,0 +1,73 @@
+import dataclasses
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir() -> str:
+    return os.environ.get("APE_CACHE_DIR") or os.path.abspath(".cache")
+
+
+@dataclasses.dataclass()
+class CacheEntry(object):
+    data: Any
+    timestamp: float
+    etag: str = ""
+    last_modified: str = ""
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.timestamp < ttl
+
+    def validators(self) -> dict:
+        """Conditional request headers to revalidate the entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class FileCache(object):
+    """Json entries on disk, one file per key"""
+
+    def __init__(self, namespace: str, cache_dir: Optional[str] = None) -> None:
+        super().__init__()
+        self.cache_dir = os.path.join(cache_dir or get_cache_dir(), namespace)
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, re.sub(r"[^\w.-]", "_", key) + ".json")
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                return CacheEntry(**json.load(f))
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignore broken cache file {path}: {e}")
+            return None
+
+    def set(self, key: str, data: Any, etag: str = "", last_modified: str = ""):
+        entry = CacheEntry(data, time.time(), etag=etag, last_modified=last_modified)
+        self.save(key, entry)
+        return entry
+
+    def touch(self, key: str, entry: CacheEntry):
+        entry.timestamp = time.time()
+        self.save(key, entry)
+
+    def save(self, key: str, entry: CacheEntry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        # write then rename, a reader never sees a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dataclasses.asdict(entry), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
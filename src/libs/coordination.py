@@ -0,0 +1,214 @@
+import abc
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CoordinationStore(abc.ABC):
+    """Shared state of the nodes of a cluster: who is alive and who holds which lease"""
+
+    @abc.abstractmethod
+    def heartbeat(self, node_id: str, ttl: float):
+        pass
+
+    @abc.abstractmethod
+    def leave(self, node_id: str):
+        pass
+
+    @abc.abstractmethod
+    def get_nodes(self) -> list[str]:
+        """The nodes whose heartbeat has not expired"""
+        pass
+
+    @abc.abstractmethod
+    def acquire(self, key: str, node_id: str, ttl: float) -> bool:
+        """Take or renew the lease of key"""
+        pass
+
+    @abc.abstractmethod
+    def release(self, key: str, node_id: str):
+        pass
+
+    @abc.abstractmethod
+    def get_holder(self, key: str) -> Optional[str]:
+        pass
+
+
+class SqliteCoordinationStore(CoordinationStore):
+    """
+    For nodes sharing a local disk, SQLite locks the file for every transaction.
+    Not safe on network file systems.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        # isolation_level None, every lease is one explicit immediate transaction
+        self.connection = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, expires_at REAL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(key TEXT PRIMARY KEY, node_id TEXT, expires_at REAL)"
+            )
+
+    def heartbeat(self, node_id: str, ttl: float):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO nodes VALUES (?, ?)", (node_id, now + ttl)
+            )
+            # notification leases pile up otherwise
+            self.connection.execute("DELETE FROM leases WHERE expires_at <= ?", (now,))
+
+    def leave(self, node_id: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+
+    def get_nodes(self) -> list[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT node_id FROM nodes WHERE expires_at > ? ORDER BY node_id",
+                (time.time(),),
+            ).fetchall()
+        return [i[0] for i in rows]
+
+    def acquire(self, key: str, node_id: str, ttl: float) -> bool:
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.cursor()
+            # the write lock is taken before reading, two nodes never both see a free lease
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                row = cursor.execute(
+                    "SELECT node_id, expires_at FROM leases WHERE key = ?", (key,)
+                ).fetchone()
+                is_free = not (row and row[0] != node_id and row[1] > now)
+                if is_free:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                        (key, node_id, now + ttl),
+                    )
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return is_free
+
+    def release(self, key: str, node_id: str):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM leases WHERE key = ? AND node_id = ?", (key, node_id)
+            )
+
+    def get_holder(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT node_id FROM leases WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+
+def get_default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ClusterCoordinator(object):
+    """
+    Split the work of the monitors running on several nodes. Targets are assigned
+    by rendezvous hashing over the live nodes, so a joining or leaving node only
+    moves its share. Notifications and orders are guarded by leases.
+    """
+
+    def __init__(
+        self,
+        store: CoordinationStore,
+        node_id: str = "",
+        heartbeat_interval: float = 5,
+        node_ttl: float = 15,
+        order_ttl: float = 300,
+        fulfilled_ttl: float = 24 * 60 * 60,
+    ) -> None:
+        super().__init__()
+        self.store = store
+        self.node_id = node_id or get_default_node_id()
+        self.heartbeat_interval = heartbeat_interval
+        self.node_ttl = node_ttl
+        # longer than waiting for a session or any checkout step, the lease is
+        # renewed before every step, a crashed node frees its order after that
+        self.order_ttl = order_ttl
+        # the same database may serve the next release
+        self.fulfilled_ttl = fulfilled_ttl
+        self.nodes: list[str] = []
+        self.nodes_at = 0.0
+        self.is_stop = threading.Event()
+
+    def start(self):
+        self.store.heartbeat(self.node_id, self.node_ttl)
+        logger.info(f"Joined the cluster as {self.node_id}")
+        threading.Thread(
+            target=self.handle_heartbeat, name="Heartbeat", daemon=True
+        ).start()
+
+    def stop(self):
+        self.is_stop.set()
+        self.store.leave(self.node_id)
+
+    def handle_heartbeat(self):
+        while not self.is_stop.wait(self.heartbeat_interval):
+            try:
+                self.store.heartbeat(self.node_id, self.node_ttl)
+            except Exception as e:
+                logging.exception("Cluster heartbeat failed with error: ", exc_info=e)
+
+    def get_nodes(self) -> list[str]:
+        if time.time() - self.nodes_at >= self.heartbeat_interval:
+            nodes = self.store.get_nodes()
+            if nodes != self.nodes:
+                logger.info(f"Cluster nodes: {', '.join(nodes)}")
+            self.nodes, self.nodes_at = nodes, time.time()
+        return self.nodes
+
+    @staticmethod
+    def get_weight(node_id: str, key: str) -> int:
+        # not hash(), it differs between processes
+        return int.from_bytes(
+            hashlib.sha1(f"{node_id}/{key}".encode()).digest()[:8], "big"
+        )
+
+    def owns(self, key: str) -> bool:
+        """Whether this node should poll the target of key"""
+        nodes = self.get_nodes()
+        if not nodes:
+            return True
+        return max(nodes, key=lambda x: self.get_weight(x, key)) == self.node_id
+
+    def claim_notification(self, key: str, ttl: float) -> bool:
+        """Only the first node to see an event pushes it within ttl"""
+        return self.store.acquire(f"notify/{key}", self.node_id, ttl)
+
+    def acquire_order(self, buyer: str) -> bool:
+        """One node at a time orders for a buyer, whatever the model, also renews"""
+        return self.store.acquire(f"order/{buyer}", self.node_id, self.order_ttl)
+
+    def release_order(self, buyer: str):
+        self.store.release(f"order/{buyer}", self.node_id)
+
+    def set_fulfilled(self, buyer: str):
+        self.store.acquire(f"fulfilled/{buyer}", self.node_id, self.fulfilled_ttl)
+
+    def is_fulfilled(self, buyer: str) -> bool:
+        return self.store.get_holder(f"fulfilled/{buyer}") is not None
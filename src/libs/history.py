@@ -0,0 +1,289 @@
+import dataclasses
+import logging
+import queue
+import sqlite3
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+
+from common.schemas import InventoryEventSchema
+from libs.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+history_dropped_total = registry.counter(
+    "apple_history_dropped_total",
+    "History records dropped because the writer fell behind",
+)
+
+# stored as their index, the list may only grow
+event_types = ["available", "unavailable", "quote_changed"]
+
+schema = [
+    # every repeated string is stored once, the rows only hold integers
+    "CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, value TEXT UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS transitions ("
+    "at INTEGER, target INTEGER, store INTEGER, store_name INTEGER, "
+    "part INTEGER, model_name INTEGER, type INTEGER, quote INTEGER)",
+    "CREATE INDEX IF NOT EXISTS transitions_part ON transitions (part, store, at)",
+    # polls are rolled up per minute, months of 5 second polls stay small
+    "CREATE TABLE IF NOT EXISTS observations ("
+    "target INTEGER, minute INTEGER, polls INTEGER, available INTEGER, "
+    "PRIMARY KEY (target, minute)) WITHOUT ROWID",
+]
+
+
+def connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=30)
+    # readers never block the writer, and a commit does not wait for fsync
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+@dataclasses.dataclass()
+class PollRecord(object):
+    at: float
+    target: str
+    available: int
+    events: list[InventoryEventSchema]
+
+
+class HistoryWriter(object):
+    """
+    Append the inventory transitions and a per minute summary of the polls to SQLite.
+    record() only queues, a background thread writes in batches.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = 10000,
+        batch_size: int = 500,
+        interval: float = 2,
+    ) -> None:
+        super().__init__()
+        self.path = path
+        self.records: queue.Queue[Optional[PollRecord]] = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.names: dict[str, int] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.handle_records, name="History", daemon=True
+        )
+        self.thread.start()
+        logger.info(f"Recording the inventory history to {self.path}")
+
+    def close(self, timeout: float = 10):
+        """Write what is queued and stop"""
+        if not self.thread:
+            return
+        self.records.put(None)
+        self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def record(self, target: str, available: int, events: list[InventoryEventSchema]):
+        try:
+            self.records.put_nowait(PollRecord(time.time(), target, available, events))
+        except queue.Full:
+            history_dropped_total.inc()
+
+    def handle_records(self):
+        connection = connect(self.path)
+        is_stop = False
+        while not is_stop:
+            batch = []
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.records.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if record is None:
+                    is_stop = True
+                    break
+                batch.append(record)
+            if not batch:
+                continue
+            try:
+                self.write(connection, batch)
+            except sqlite3.Error as e:
+                logging.exception(
+                    f"Failed to write {len(batch)} history records with error: ",
+                    exc_info=e,
+                )
+                connection.rollback()
+                # the ids of the names inserted by the batch are gone as well
+                self.names.clear()
+        connection.close()
+
+    def write(self, connection: sqlite3.Connection, batch: list[PollRecord]):
+        observations: dict[tuple[int, int], list[int]] = {}
+        transitions = []
+        for record in batch:
+            target = self.get_name_id(connection, record.target)
+            minute = int(record.at // 60)
+            observation = observations.setdefault((target, minute), [0, 0])
+            observation[0] += 1
+            observation[1] = max(observation[1], record.available)
+            for event in record.events:
+                delivery = event.delivery
+                transitions.append(
+                    (
+                        int(record.at),
+                        target,
+                        self.get_name_id(connection, delivery.store_number),
+                        self.get_name_id(connection, delivery.store_name),
+                        self.get_name_id(connection, delivery.model),
+                        self.get_name_id(connection, delivery.model_name),
+                        event_types.index(event.type),
+                        self.get_name_id(connection, delivery.pickup_quote),
+                    )
+                )
+        with connection:
+            connection.executemany(
+                "INSERT INTO transitions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", transitions
+            )
+            connection.executemany(
+                "INSERT INTO observations VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (target, minute) DO UPDATE SET "
+                "polls = polls + excluded.polls, available = max(available, excluded.available)",
+                [(k[0], k[1], v[0], v[1]) for k, v in observations.items()],
+            )
+
+    def get_name_id(self, connection: sqlite3.Connection, value: str) -> int:
+        name_id = self.names.get(value)
+        if name_id is None:
+            connection.execute(
+                "INSERT OR IGNORE INTO names (value) VALUES (?)", (value,)
+            )
+            name_id = connection.execute(
+                "SELECT id FROM names WHERE value = ?", (value,)
+            ).fetchone()[0]
+            self.names[value] = name_id
+        return name_id
+
+
+@dataclasses.dataclass()
+class RestockRun(object):
+    store_number: str
+    store_name: str
+    model: str
+    model_name: str
+    quote: str
+    # the monitoring target that reported it first
+    target: str
+    started_at: int
+    # None while still available
+    ended_at: Optional[int] = None
+
+    def duration(self) -> Optional[int]:
+        return None if self.ended_at is None else self.ended_at - self.started_at
+
+    def intro(self) -> str:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started_at))
+        duration = self.duration()
+        lasted = "still available" if duration is None else f"lasted {duration}s"
+        return f"{started} {self.store_number} {self.store_name} {self.model} {self.quote}, {lasted}"
+
+
+@dataclasses.dataclass()
+class RestockSummary(object):
+    store_number: str
+    model: str
+    count: int
+    median_duration: Optional[float]
+    # the local hours restocks started at, the most frequent first
+    hours: list[tuple[int, int]]
+
+    def intro(self) -> str:
+        duration = (
+            "-" if self.median_duration is None else f"{self.median_duration:.0f}s"
+        )
+        hours = ", ".join(f"{hour:02d}h x{count}" for hour, count in self.hours[:3])
+        return f"{self.store_number} {self.model}: {self.count} restocks, median {duration}, at {hours}"
+
+
+def get_restock_runs(
+    path: str,
+    stores: Optional[Iterable[str]] = None,
+    models: Optional[Iterable[str]] = None,
+    since: float = 0,
+) -> list[RestockRun]:
+    """
+    Pair every available transition with the next unavailable one of the same store part.
+    stores are matched like the store filter, as a part of the store name or number.
+    """
+    stores, models = list(stores or []), list(models or [])
+    # filtered in SQLite, the part filter is served by the transitions_part index
+    conditions, params = ["t.at >= ?"], [int(since)]
+    if models:
+        placeholders = ", ".join("?" * len(models))
+        conditions.append(
+            f"t.part IN (SELECT id FROM names WHERE value IN ({placeholders}))"
+        )
+        params += models
+    if stores:
+        matches = "SELECT id FROM names WHERE " + " OR ".join(
+            ["instr(value, ?) > 0"] * len(stores)
+        )
+        conditions.append(f"(t.store IN ({matches}) OR t.store_name IN ({matches}))")
+        params += stores * 2
+    connection = connect(path)
+    try:
+        rows = connection.execute(
+            "SELECT t.at, tn.value, s.value, sn.value, p.value, pn.value, t.type, q.value "
+            "FROM transitions t JOIN names tn ON tn.id = t.target "
+            "JOIN names s ON s.id = t.store JOIN names sn ON sn.id = t.store_name "
+            "JOIN names p ON p.id = t.part JOIN names pn ON pn.id = t.model_name "
+            "JOIN names q ON q.id = t.quote "
+            f"WHERE {' AND '.join(conditions)} ORDER BY t.at, t.rowid",
+            params,
+        ).fetchall()
+    finally:
+        connection.close()
+
+    runs = []
+    open_runs: dict[tuple[str, str], RestockRun] = {}
+    for row in rows:
+        at, target, store_number, store_name, model, model_name, type_idx, quote = row
+        key = (store_number, model)
+        event_type = event_types[type_idx]
+        if event_type == "available":
+            # reported again by a restarted monitor or after a failed order
+            if key not in open_runs:
+                open_runs[key] = RestockRun(
+                    store_number, store_name, model, model_name, quote, target, at
+                )
+                runs.append(open_runs[key])
+        elif event_type == "unavailable" and key in open_runs:
+            open_runs.pop(key).ended_at = at
+    return runs
+
+
+def summarize_runs(runs: list[RestockRun]) -> list[RestockSummary]:
+    grouped: dict[tuple[str, str], list[RestockRun]] = defaultdict(list)
+    for run in runs:
+        grouped[(run.store_number, run.model)].append(run)
+    summaries = []
+    for (store_number, model), items in sorted(grouped.items()):
+        durations = [i.duration() for i in items if i.duration() is not None]
+        hours = Counter(time.localtime(i.started_at).tm_hour for i in items)
+        summaries.append(
+            RestockSummary(
+                store_number,
+                model,
+                len(items),
+                statistics.median(durations) if durations else None,
+                hours.most_common(),
+            )
+        )
+    return summaries
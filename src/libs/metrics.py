@@ -0,0 +1,244 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a parsed payload up to a slow checkout poll
+default_buckets = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metric(object):
+    """One metric family, a child per label values"""
+
+    type = ""
+
+    def __init__(
+        self, name: str, documentation: str, labels: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.children: dict[tuple[str, ...], object] = {}
+
+    def label_values(self, labels: dict) -> tuple[str, ...]:
+        assert set(labels) == set(
+            self.label_names
+        ), f"{self.name} expects labels {self.label_names}, got {tuple(labels)}"
+        return tuple(str(labels[i]) for i in self.label_names)
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self.lock:
+            for values, child in sorted(self.children.items()):
+                lines.extend(self.expose_child(values, child))
+        return lines
+
+    def expose_child(self, values: tuple[str, ...], child) -> list[str]:
+        return [f"{self.name}{format_labels(self.label_names, values)} {child}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        assert amount >= 0, "Counters only go up"
+        values = self.label_values(labels)
+        with self.lock:
+            self.children[values] = self.children.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            self.children[values] = value
+
+    def set_function(self, func: Callable[[], float], **labels):
+        """Evaluated on every scrape, for values such as an age that change by themselves"""
+        values = self.label_values(labels)
+        with self.lock:
+            self.children[values] = func
+
+    def remove(self, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            self.children.pop(values, None)
+
+    def expose_child(self, values: tuple[str, ...], child) -> list[str]:
+        value = child() if callable(child) else child
+        return [f"{self.name}{format_labels(self.label_names, values)} {value}"]
+
+
+class HistogramData(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = default_buckets,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        values = self.label_values(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.children.get(values)
+            if data is None:
+                data = self.children[values] = HistogramData(len(self.buckets) + 1)
+            data.counts[idx] += 1
+            data.sum += value
+            data.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def expose_child(self, values: tuple[str, ...], child: HistogramData) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(
+                f"{self.name}_bucket{format_labels(self.label_names, values, le=le)} {cumulative}"
+            )
+        label_str = format_labels(self.label_names, values)
+        lines.append(f"{self.name}_sum{label_str} {child.sum}")
+        lines.append(f"{self.name}_count{label_str} {child.count}")
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self) -> None:
+        super().__init__()
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                existing = self.metrics[metric.name]
+                assert type(existing) is type(
+                    metric
+                ), f"{metric.name} is already registered"
+                return existing
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: tuple[str, ...] = ()
+    ) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(
+        self, name: str, documentation: str, labels: tuple[str, ...] = ()
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = default_buckets,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def expose(self) -> str:
+        """The registry in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = registry
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+
+def start_metrics_server(
+    port: int, host: str = "0.0.0.0", metrics_registry: Optional[MetricsRegistry] = None
+) -> ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread"""
+    handler = type(
+        "Handler", (MetricsHandler,), {"registry": metrics_registry or registry}
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logger.info(f"Metrics served on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -1,101 +1,401 @@
 import abc
+import asyncio
+import dataclasses
 import logging
+import queue
+import threading
 import time
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 from urllib.parse import quote_plus
 
-import requests
+from libs.metrics import registry
+from libs.requests import Request
+
+if TYPE_CHECKING:
+    from libs.async_requests import AsyncRequest
+
+logger = logging.getLogger(__name__)
+
+push_seconds = registry.histogram(
+    "apple_notification_push_seconds", "Latency of notification pushes", ("provider",)
+)
+push_total = registry.counter(
+    "apple_notification_pushes_total",
+    "Notification push attempts by result",
+    ("provider", "result"),
+)
 
 
 class NotificationBase(object):
     name: str
+    default_host: str
 
-    def __init__(self, token: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        host: Optional[str] = None,
+        timeout: float = 10,
+        retries: int = 2,
+        pool_size: int = 2,
+    ) -> None:
         super().__init__()
         self.token = token
-        self.last_push_maps: dict[str, float] = {}
+        self.host = (host or self.default_host).rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        # keep-alive session, pushes during a restock wave reuse the connection.
+        # never recorded, the urls and bodies hold the provider tokens
+        self.session = Request(
+            self.host, timeout=timeout, pool_size=pool_size, recordable=False
+        )
+        self.pool_size = pool_size
+        # created on the event loop of the first async push
+        self.async_session: Optional["AsyncRequest"] = None
 
-    def push(
-        self, title: str, content: str, key: str = "default", min_interval: int = 0
-    ):
-        if (
-            min_interval
-            and self.last_push_maps.get(key)
-            and (time.time() - self.last_push_maps[key]) < min_interval
-        ):
-            logging.info("Pushing too frequently, wait for the next push")
-            return
+    def push_data(self, title: str, content: str):
+        method, path, kwargs = self.get_push_request(title, content)
+        resp = getattr(self.session, method)(path, **kwargs)
+        self.check_push(resp.json())
 
-        self.push_data(title, content)
+    async def push_data_async(self, title: str, content: str):
+        from libs.async_requests import AsyncRequest
 
-        self.last_push_maps[key] = time.time()
+        if not self.async_session:
+            self.async_session = AsyncRequest(
+                self.host, timeout=self.timeout, pool_size=self.pool_size
+            )
+        method, path, kwargs = self.get_push_request(title, content)
+        resp = await getattr(self.async_session, method)(path, **kwargs)
+        self.check_push(resp.json())
 
-    def repeat_push(
-        self, title: str, content: str, max_count: int = 0, interval: int = 5
-    ):
-        max_count = 1024 * 1024 if max_count <= 0 else max_count
-        for i in range(0, max_count):
-            self.push_data(title, content)
-            time.sleep(interval)
+    async def close_async(self):
+        if self.async_session:
+            await self.async_session.close()
+            self.async_session = None
 
     @abc.abstractmethod
-    def push_data(self, title: str, content: str):
+    def get_push_request(self, title: str, content: str) -> tuple[str, str, dict]:
+        """The session method, path and arguments of a push"""
+        pass
+
+    @abc.abstractmethod
+    def check_push(self, resp_json: dict):
         pass
 
 
 class DingTalkNotification(NotificationBase):
     name = "dingtalk"
+    default_host = "https://oapi.dingtalk.com"
 
-    def push_data(self, title: str, content: str):
+    def get_push_request(self, title: str, content: str) -> tuple[str, str, dict]:
         assert self.token, "Access_token credentials must be provided"
-        url = f"https://oapi.dingtalk.com/robot/send?access_token={self.token}"
-        resp = requests.post(
-            url,
-            json={
-                "msgtype": "text",
-                "text": {"content": title + "\r\n\r\n" + content},
-                "at": {"isAtAll": 0},
-            },
+        return (
+            "post",
+            "/robot/send",
+            dict(
+                params={"access_token": self.token},
+                json={
+                    "msgtype": "text",
+                    "text": {"content": title + "\r\n\r\n" + content},
+                    "at": {"isAtAll": 0},
+                },
+                fetch_header=False,
+            ),
         )
-        resp_json = resp.json()
 
+    def check_push(self, resp_json: dict):
         assert resp_json.get("errcode") == 0, resp_json.get("errmsg")
 
 
 class BarkNotification(NotificationBase):
     name = "bark"
+    default_host = "https://api.day.app"
 
-    def __init__(
-        self,
-        token: Optional[str] = None,
-        host: Optional[str] = None,
-    ) -> None:
-        super().__init__(token=token)
-        self.host = (host or "https://api.day.app").rstrip("/")
-
-    def push_data(self, title: str, content: str):
+    def get_push_request(self, title: str, content: str) -> tuple[str, str, dict]:
         assert self.token, "Token credentials must be provided"
         title, content = quote_plus(title), quote_plus(content)
-        url = f"{self.host}/{self.token}/{title}/{content}"
-        resp = requests.get(url)
-        resp_json = resp.json()
+        return "get", f"/{self.token}/{title}/{content}", {}
 
+    def check_push(self, resp_json: dict):
         assert resp_json.get("code") == 200, resp_json.get("message")
 
 
 class FeishuNotification(NotificationBase):
     name = "feishu"
+    default_host = "https://open.feishu.cn"
 
-    def push_data(self, title: str, content: str):
+    def get_push_request(self, title: str, content: str) -> tuple[str, str, dict]:
         assert self.token, "token credentials must be provided"
-        url = f"https://open.feishu.cn/open-apis/bot/v2/hook/{self.token}"
-        resp = requests.post(
-            url,
-            json={
-                "msg_type": "text",
-                "content": {"text": title + "\r\n\r\n" + content},
-            },
+        return (
+            "post",
+            f"/open-apis/bot/v2/hook/{self.token}",
+            dict(
+                json={
+                    "msg_type": "text",
+                    "content": {"text": title + "\r\n\r\n" + content},
+                },
+                fetch_header=False,
+            ),
         )
-        resp_json = resp.json()
 
+    def check_push(self, resp_json: dict):
         assert resp_json.get("code") == 0, resp_json.get("msg")
+
+
+@dataclasses.dataclass()
+class NotificationJob(object):
+    provider: NotificationBase
+    title: str
+    content: str
+    key: str = "default"
+    repeat: int = 1
+    repeat_interval: float = 5
+
+
+@dataclasses.dataclass()
+class ProviderStats(object):
+    count: int = 0
+    errors: int = 0
+    last_latency: float = 0
+    total_latency: float = 0
+
+    def avg_latency(self) -> float:
+        return self.total_latency / self.count if self.count else 0
+
+
+class NotificationDispatcher(object):
+    """
+    Push through a bounded queue drained by worker threads, so a slow provider
+    never blocks the caller. Pushes throttled by min_interval are merged and
+    sent when the interval has passed instead of being dropped.
+    """
+
+    def __init__(self, workers: int = 2, max_size: int = 100) -> None:
+        super().__init__()
+        self.jobs: queue.Queue[NotificationJob] = queue.Queue(maxsize=max_size)
+        self.stats: dict[str, ProviderStats] = {}
+        self.last_push_maps: dict[tuple[str, str], float] = {}
+        self.deferred_jobs: dict[tuple[str, str], NotificationJob] = {}
+        self.lock = threading.Lock()
+        self.pending_condition = threading.Condition()
+        self.pending = 0
+
+        for idx in range(workers):
+            thread = threading.Thread(
+                target=self.handle_jobs, name=f"Notification_{idx}", daemon=True
+            )
+            thread.start()
+
+    def push(
+        self,
+        provider: NotificationBase,
+        title: str,
+        content: str,
+        key: str = "default",
+        min_interval: int = 0,
+    ):
+        job = NotificationJob(provider, title, content, key=key)
+        if not min_interval:
+            self.submit(job)
+            return
+
+        job_key = (provider.name, key)
+        with self.lock:
+            deferred_job = self.deferred_jobs.get(job_key)
+            if deferred_job:
+                deferred_job.content += "\r\n" + content
+                return
+            wait = min_interval - (time.time() - self.last_push_maps.get(job_key, 0))
+            if wait <= 0:
+                self.last_push_maps[job_key] = time.time()
+            else:
+                self.deferred_jobs[job_key] = job
+        if wait <= 0:
+            self.submit(job)
+            return
+
+        logger.info(f"Pushing too frequently, {provider.name} push delayed {wait:.0f}s")
+        self.submit_later(wait, self.submit_deferred, job_key)
+
+    def repeat_push(
+        self,
+        provider: NotificationBase,
+        title: str,
+        content: str,
+        max_count: int = 0,
+        interval: int = 5,
+    ):
+        max_count = 1024 * 1024 if max_count <= 0 else max_count
+        self.submit(
+            NotificationJob(
+                provider, title, content, repeat=max_count, repeat_interval=interval
+            )
+        )
+
+    def submit(self, job: NotificationJob):
+        self.add_pending()
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            logger.warning(
+                f"Notification queue is full, {job.provider.name} push dropped"
+            )
+            self.done_pending()
+
+    def submit_later(self, delay: float, callback, *args):
+        def run():
+            try:
+                callback(*args)
+            finally:
+                self.done_pending()
+
+        self.add_pending()
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        timer.start()
+
+    def submit_deferred(self, job_key: tuple[str, str]):
+        with self.lock:
+            job = self.deferred_jobs.pop(job_key)
+            self.last_push_maps[job_key] = time.time()
+        self.submit(job)
+
+    def handle_jobs(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self.deliver(job)
+                if job.repeat > 1:
+                    self.submit_later(
+                        job.repeat_interval,
+                        self.submit,
+                        dataclasses.replace(job, repeat=job.repeat - 1),
+                    )
+            finally:
+                self.done_pending()
+
+    def deliver(self, job: NotificationJob):
+        provider = job.provider
+        for attempt in range(provider.retries + 1):
+            start_time = time.time()
+            try:
+                provider.push_data(job.title, job.content)
+            except Exception as e:
+                self.record_error(provider, attempt, e)
+                if attempt < provider.retries:
+                    time.sleep(min(2**attempt, 10))
+                continue
+            self.record_push(provider, time.time() - start_time)
+            return
+
+    def record_push(self, provider: NotificationBase, latency: float):
+        stats = self.stats.setdefault(provider.name, ProviderStats())
+        push_seconds.observe(latency, provider=provider.name)
+        push_total.inc(provider=provider.name, result="success")
+        stats.count += 1
+        stats.last_latency = latency
+        stats.total_latency += latency
+        logger.debug(
+            f"{provider.name} push took {latency:.3f}s, queue size {self.qsize()}"
+        )
+
+    def record_error(self, provider: NotificationBase, attempt: int, e: Exception):
+        self.stats.setdefault(provider.name, ProviderStats()).errors += 1
+        push_total.inc(provider=provider.name, result="error")
+        logger.exception(
+            f"{provider.name} push failed, attempt {attempt + 1}", exc_info=e
+        )
+
+    def qsize(self) -> int:
+        return self.jobs.qsize()
+
+    def add_pending(self):
+        with self.pending_condition:
+            self.pending += 1
+
+    def done_pending(self):
+        with self.pending_condition:
+            self.pending -= 1
+            self.pending_condition.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until queued, delayed and repeated pushes are all done"""
+        with self.pending_condition:
+            return self.pending_condition.wait_for(
+                lambda: self.pending <= 0, timeout=timeout
+            )
+
+
+class AsyncNotificationDispatcher(NotificationDispatcher):
+    """
+    Push as tasks of an event loop instead of worker threads, the same throttling
+    and merging. Jobs may be submitted from any thread once the loop is bound.
+    """
+
+    def __init__(self, max_size: int = 100) -> None:
+        super().__init__(workers=0, max_size=max_size)
+        self.max_size = max_size
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.tasks: set[asyncio.Task] = set()
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def submit(self, job: NotificationJob):
+        assert self.loop, "Bind the dispatcher to an event loop first"
+        if self.pending >= self.max_size:
+            logger.warning(
+                f"Notification queue is full, {job.provider.name} push dropped"
+            )
+            return
+        self.add_pending()
+        self.loop.call_soon_threadsafe(self.start_job, job)
+
+    def submit_later(self, delay: float, callback, *args):
+        def run():
+            try:
+                callback(*args)
+            finally:
+                self.done_pending()
+
+        self.add_pending()
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, run)
+
+    def start_job(self, job: NotificationJob):
+        task = self.loop.create_task(self.handle_job(job))
+        # the loop only keeps weak references to its tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_job(self, job: NotificationJob):
+        try:
+            await self.deliver_async(job)
+            if job.repeat > 1:
+                self.submit_later(
+                    job.repeat_interval,
+                    self.submit,
+                    dataclasses.replace(job, repeat=job.repeat - 1),
+                )
+        finally:
+            self.done_pending()
+
+    async def deliver_async(self, job: NotificationJob):
+        provider = job.provider
+        for attempt in range(provider.retries + 1):
+            start_time = time.time()
+            try:
+                await provider.push_data_async(job.title, job.content)
+            except Exception as e:
+                self.record_error(provider, attempt, e)
+                if attempt < provider.retries:
+                    await asyncio.sleep(min(2**attempt, 10))
+                continue
+            self.record_push(provider, time.time() - start_time)
+            return
+
+    def qsize(self) -> int:
+        return len(self.tasks)
+
+    async def join_async(self, timeout: Optional[float] = None) -> bool:
+        """join without blocking the loop that delivers the pushes"""
+        return await asyncio.to_thread(self.join, timeout)
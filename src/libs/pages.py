@@ -0,0 +1,22 @@
+import json
+from typing import Any
+
+json_decoder = json.JSONDecoder()
+
+whitespaces = " \t\r\n"
+
+
+def extract_json(content: str, *markers: str) -> Any:
+    """
+    Decode the json value embedded in a page right after the markers,
+    the markers are located one after another with plain finds.
+    """
+    idx = 0
+    for marker in markers:
+        idx = content.find(marker, idx)
+        assert idx >= 0, f"{marker} not found"
+        idx += len(marker)
+    while content[idx] in whitespaces:
+        idx += 1
+    data, _ = json_decoder.raw_decode(content, idx)
+    return data
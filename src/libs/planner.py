@@ -0,0 +1,172 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+from common.schemas import ShopSchema
+from libs.history import get_restock_runs
+from libs.scheduler import AdaptiveScheduler
+
+logger = logging.getLogger(__name__)
+
+# how much of the neighbouring buckets counts, restocks drift by a few minutes
+kernel = {-1: 0.25, 0: 0.5, 1: 0.25}
+
+
+class RestockPlanner(object):
+    """
+    Split a budget of requests per minute between the targets by the time of day
+    their stores and parts restocked before, according to the inventory history.
+    Quiet targets keep a share through the prior, so new stock is still found.
+    The targets another node of the cluster polls take no share.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        requests_per_minute: float = 0,
+        bucket_minutes: int = 15,
+        days: int = 30,
+        prior: float = 0.1,
+        min_interval: float = 1,
+        max_interval: float = 60,
+        refresh_interval: float = 3600,
+    ) -> None:
+        """requests_per_minute 0 spends what the fixed intervals of the targets would"""
+        super().__init__()
+        self.path = path
+        self.requests_per_minute = requests_per_minute
+        self.bucket_minutes = bucket_minutes
+        self.buckets = 24 * 60 // bucket_minutes
+        self.days = days
+        self.prior = prior
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.refresh_interval = refresh_interval
+
+        self.targets: dict[str, ShopSchema] = {}
+        self.base_intervals: dict[str, float] = {}
+        self.unowned: set[str] = set()
+        # restocks per bucket of every (store number, part)
+        self.histograms: dict[tuple[str, str], list[float]] = {}
+        # the store parts seen by every target
+        self.target_parts: dict[str, set[tuple[str, str]]] = {}
+        self.loaded_at = 0.0
+        self.plan_bucket: Optional[int] = None
+        self.intervals: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def add_target(self, shop_data: ShopSchema, interval: float):
+        with self.lock:
+            self.targets[shop_data.key()] = shop_data
+            self.base_intervals[shop_data.key()] = interval
+            self.plan_bucket = None
+
+    def set_owned(self, key: str, owned: bool):
+        with self.lock:
+            if owned == (key not in self.unowned):
+                return
+            if owned:
+                self.unowned.discard(key)
+            else:
+                self.unowned.add(key)
+            self.plan_bucket = None
+
+    def get_bucket(self, timestamp: float) -> int:
+        local_time = time.localtime(timestamp)
+        return (local_time.tm_hour * 60 + local_time.tm_min) // self.bucket_minutes
+
+    def load(self):
+        # the stock reported again after a failed order or a restart is not a restock
+        runs = get_restock_runs(self.path, since=time.time() - self.days * 86400)
+
+        histograms = defaultdict(lambda: [0.0] * self.buckets)
+        target_parts = defaultdict(set)
+        for run in runs:
+            key = (run.store_number, run.model)
+            bucket = self.get_bucket(run.started_at)
+            for offset, weight in kernel.items():
+                histograms[key][(bucket + offset) % self.buckets] += weight
+            target_parts[run.target].add(key)
+        with self.lock:
+            self.histograms, self.target_parts = dict(histograms), dict(target_parts)
+            self.plan_bucket = None
+        logger.info(
+            f"Restock plan learned from {len(runs)} restocks of {len(self.histograms)} store parts"
+        )
+
+    def get_weight(self, key: str, bucket: int) -> float:
+        shop_data = self.targets[key]
+        # a new target borrows the history of its parts at every store
+        parts = self.target_parts.get(key) or [
+            i for i in self.histograms if i[1] in shop_data.models
+        ]
+        return self.prior + sum(self.histograms[i][bucket] for i in parts)
+
+    def refresh(self):
+        try:
+            self.load()
+        except sqlite3.Error as e:
+            logging.exception(
+                "Failed to load the restock history with error: ", exc_info=e
+            )
+
+    def plan(self, bucket: int) -> dict[str, float]:
+        owned = [i for i in self.targets if i not in self.unowned]
+        weights = {i: self.get_weight(i, bucket) for i in owned}
+        budget = self.requests_per_minute or sum(
+            60 / self.base_intervals[i] for i in owned
+        )
+        max_rate = 60 / self.min_interval
+        rates = {}
+        # the share a target cannot use below min_interval goes to the others
+        while weights:
+            total = sum(weights.values())
+            capped = [k for k, v in weights.items() if budget * v / total > max_rate]
+            if not capped:
+                rates.update({k: budget * v / total for k, v in weights.items()})
+                break
+            for key in capped:
+                rates[key] = max_rate
+                budget -= max_rate
+                weights.pop(key)
+        min_rate = 60 / self.max_interval
+        return {k: 60 / max(v, min_rate) for k, v in rates.items()}
+
+    def get_interval(self, key: str) -> float:
+        now = time.time()
+        with self.lock:
+            if now - self.loaded_at >= self.refresh_interval:
+                # the previous plan is kept until the history is loaded
+                self.loaded_at = now
+                threading.Thread(
+                    target=self.refresh, name="RestockPlan", daemon=True
+                ).start()
+            bucket = self.get_bucket(now)
+            if bucket != self.plan_bucket:
+                self.intervals = self.plan(bucket)
+                self.plan_bucket = bucket
+                logger.debug(
+                    "Query intervals: "
+                    + ", ".join(f"{k} {v:.1f}s" for k, v in self.intervals.items())
+                )
+            # an unowned target only checks whether it came back
+            return self.intervals.get(key, self.base_intervals[key])
+
+
+class PlannedScheduler(AdaptiveScheduler):
+    """AdaptiveScheduler whose interval follows the restock plan of its target"""
+
+    def __init__(
+        self, interval: float, planner: RestockPlanner, shop_data: ShopSchema
+    ) -> None:
+        super().__init__(interval)
+        self.planner = planner
+        self.key = shop_data.key()
+        planner.add_target(shop_data, interval)
+
+    def next_delay(self) -> float:
+        self.interval = self.planner.get_interval(self.key)
+        return super().next_delay()
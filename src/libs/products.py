@@ -1,35 +1,63 @@
-import json
-import re
+import dataclasses
+import logging
+from typing import Optional
 
 import requests
 
 from common.schemas import ProductSchema
+from libs.cache import FileCache
+from libs.pages import extract_json
 
+product_cache = FileCache("products")
+
+
+def get_products(
+    code: str,
+    country: str,
+    ttl: int = 60 * 60 * 24,
+    offline: bool = False,
+    cache: Optional[FileCache] = product_cache,
+):
+    """
+    Parsed products are cached by (country, code), a fresh entry is served without a request
+    and a stale one is revalidated with its ETag/Last-Modified. ttl=0 disables the cache.
+    """
+    cache_key = f"{country}-{code}"
+    entry = cache.get(cache_key) if cache and ttl else None
+    if entry and (offline or entry.is_fresh(ttl)):
+        return [ProductSchema(**i) for i in entry.data]
+    assert not offline, f"No cached products of {country} {code}"
 
-def get_products(code: str, country: str):
     default_headers = {
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/117.0",
     }
     resp = requests.get(
         f"https://www.apple.com/{country}/shop/buy-iphone/iphone-{code}",
-        headers=default_headers,
+        headers=default_headers | (entry.validators() if entry else {}),
     )
+    if entry and resp.status_code == 304:
+        logging.debug(f"Products of {country} {code} not modified")
+        cache.touch(cache_key, entry)
+        return [ProductSchema(**i) for i in entry.data]
+
     content = resp.text
     assert "productSelectionData" in resp.text
-    return parse_products(content)
+    products = parse_products(content)
+    if cache and ttl:
+        cache.set(
+            cache_key,
+            [dataclasses.asdict(i) for i in products],
+            etag=resp.headers.get("ETag", ""),
+            last_modified=resp.headers.get("Last-Modified", ""),
+        )
+    return products
 
 
 def parse_products(content):
-    select_match = re.search(
-        r"window.PRODUCT_SELECTION_BOOTSTRAP = (.+?)</script>", content, flags=re.DOTALL
-    )
-    assert select_match
-    select_text = (
-        select_match.group(1)
-        .strip()
-        .replace("productSelectionData", '"productSelectionData"')
+    # the bootstrap is a js object, only its value is json
+    select_data = extract_json(
+        content, "window.PRODUCT_SELECTION_BOOTSTRAP", "productSelectionData", ":"
     )
-    select_data = json.loads(select_text)["productSelectionData"]
     products = []
     prices_data = select_data["displayValues"]["prices"]
     colors_data = select_data["displayValues"]["dimensionColor"]
@@ -0,0 +1,71 @@
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+from urllib.parse import urlparse, parse_qsl
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# response headers the stand-in needs to replay a response
+recorded_headers = ("Content-Type", "Location", "Retry-After")
+
+
+def get_fixture_key(method: str, url: str) -> tuple[str, str, str]:
+    """Responses are matched by method, path and the checkout action"""
+    url_parsed = urlparse(url)
+    action = dict(parse_qsl(url_parsed.query)).get("_a", "")
+    return method.upper(), url_parsed.path, action
+
+
+class ResponseRecorder(object):
+    """
+    Save every response of libs.requests.Request as a json fixture, see benchmarks.standin.
+    Only responses are kept, request bodies hold the personal delivery data.
+    """
+
+    def __init__(self, directory: str) -> None:
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.counter = itertools.count(len(os.listdir(directory)))
+        self.lock = threading.Lock()
+
+    def record(self, response: requests.Response):
+        method, path, action = get_fixture_key(response.request.method, response.url)
+        name = re.sub(r"[^\w.-]+", "_", path.strip("/"))[-60:]
+        with self.lock:
+            file_name = f"{next(self.counter):05d}_{method}_{name}{'_' + action if action else ''}.json"
+        fixture = {
+            "method": method,
+            "url": response.url,
+            "path": path,
+            "action": action,
+            "status": response.status_code,
+            "headers": {
+                k: response.headers[k]
+                for k in recorded_headers
+                if k in response.headers
+            },
+            "cookies": response.cookies.get_dict(),
+            "elapsed": response.elapsed.total_seconds(),
+            "body": response.text,
+        }
+        with open(os.path.join(self.directory, file_name), "w") as f:
+            json.dump(fixture, f, ensure_ascii=False, indent=2)
+        logger.debug(f"Recorded {method} {path} as {file_name}")
+
+
+def load_fixtures(directory: str) -> dict[tuple[str, str, str], dict]:
+    """The latest fixture of every key"""
+    fixtures = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(directory, file_name), "r") as f:
+            fixture = json.load(f)
+        fixtures[(fixture["method"], fixture["path"], fixture["action"])] = fixture
+    return fixtures
@@ -1,30 +1,201 @@
-from typing import Optional
+import collections
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Optional, TYPE_CHECKING, Union
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from libs.metrics import registry
+
+if TYPE_CHECKING:
+    from libs.recorder import ResponseRecorder
+
+logger = logging.getLogger(__name__)
+
+hedged_total = registry.counter(
+    "apple_hedged_requests_total",
+    "Hedged requests by the attempt that answered first",
+    ("winner",),
+)
+
+
+def get_accept_encoding() -> str:
+    """gzip always, br only when a brotli decoder is installed for urllib3"""
+    encodings = ["gzip", "deflate"]
+    for module in ("brotli", "brotlicffi"):
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        encodings.append("br")
+        break
+    return ", ".join(encodings)
+
+
+class DnsCache(object):
+    """Process wide cache of getaddrinfo results, so a slow resolver is paid once per ttl"""
+
+    installed: Optional["DnsCache"] = None
+
+    def __init__(self, ttl: float = 300) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results: dict[tuple, tuple[float, list]] = {}
+        self.getaddrinfo = socket.getaddrinfo
+
+    def resolve(self, *args, **kwargs):
+        key = args + tuple(sorted(kwargs.items()))
+        with self.lock:
+            cached = self.results.get(key)
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        result = self.getaddrinfo(*args, **kwargs)
+        with self.lock:
+            self.results[key] = (time.time(), result)
+        return result
+
+    @classmethod
+    def install(cls, ttl: float = 300) -> "DnsCache":
+        if cls.installed:
+            cls.installed.ttl = ttl
+            return cls.installed
+        cls.installed = cls(ttl)
+        socket.getaddrinfo = cls.installed.resolve
+        logger.info(f"DNS results are cached for {ttl}s")
+        return cls.installed
+
+
+class LatencyWindow(object):
+    """Latencies of the latest successful requests"""
+
+    def __init__(self, size: int = 200) -> None:
+        super().__init__()
+        self.latencies: collections.deque[float] = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * percentile), len(latencies) - 1)]
+
+    def __len__(self) -> int:
+        return len(self.latencies)
 
 
 class Request(object):
     default_headers = {
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:108.0) Gecko/20100101 Firefox/116.0",
+        "Accept-Encoding": get_accept_encoding(),
     }
+    # every response of every recordable session is saved when set, see libs.recorder
+    recorder: Optional["ResponseRecorder"] = None
+    # False turns hedge=True requests into plain ones
+    hedging = True
 
     def __init__(
-        self, host: str, headers: Optional[dict] = None, timeout: int = 5
+        self,
+        host: str,
+        headers: Optional[dict] = None,
+        timeout: float = 5,
+        pool_size: int = 10,
+        connect_timeout: float = 3.05,
+        retries: int = 2,
+        hedge_percentile: float = 0.95,
+        hedge_min_delay: float = 0.1,
+        hedge_max_delay: float = 2,
+        hedge_min_samples: int = 20,
+        recordable: bool = True,
     ) -> None:
+        """
+        timeout is the read timeout, a hung socket fails after connect_timeout + timeout.
+        GET is retried on connection errors and read timeouts, error statuses are not,
+        their Retry-After is left to the caller.
+        A hedged GET fires a duplicate when the first one is slower than hedge_percentile
+        of the latest latencies of its path, clamped to the min and max delay.
+        A session that is not recordable is never saved by the recorder.
+        """
         super().__init__()
         self.session = requests.Session()
         self.request_host = host
+        self.pool_size = pool_size
+        self.recordable = recordable
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=0,
+            other=0,
+            allowed_methods={"GET", "HEAD"},
+            backoff_factor=0.1,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
         self.session.headers.update(self.default_headers)
         headers and self.session.headers.update(headers)
 
-        self.default_timeout = timeout
+        self.default_timeout = (connect_timeout, timeout)
+
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies: dict[str, LatencyWindow] = {}
+        self.hedge_executor: Optional[ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
 
     def request(self, method: str, *args, **kwargs):
         kwargs = {k: v for k, v in kwargs.items() if v is not None}
-        if "timeout" in kwargs:
-            kwargs["timeout"] = self.default_timeout
-        return self.session.request(method, *args, **kwargs)
+        # every session, the order sessions included, ran without a timeout before
+        kwargs.setdefault("timeout", self.default_timeout)
+        resp = self.session.request(method, *args, **kwargs)
+        if self.recorder and self.recordable:
+            self.recorder.record(resp)
+        return resp
+
+    def warm(self, host: Optional[str] = None, count: int = 1) -> int:
+        """
+        Open up to count keep-alive connections to host ahead of the requests that need them,
+        returns the number of successful ones.
+        """
+        url = (host or self.request_host).rstrip("/") + "/"
+        count = max(min(count, self.pool_size), 1)
+
+        def head():
+            try:
+                self.session.head(
+                    url, timeout=self.default_timeout, allow_redirects=False
+                )
+                return True
+            except requests.RequestException as e:
+                logger.debug(f"Warming {url} failed: {e}")
+                return False
+
+        if count == 1:
+            return int(head())
+        # concurrent, otherwise every request reuses the first connection
+        with ThreadPoolExecutor(
+            max_workers=count, thread_name_prefix="Warm"
+        ) as executor:
+            return sum(executor.map(lambda _: head(), range(count)))
 
     def get(
         self,
@@ -32,10 +203,54 @@ class Request(object):
         params: Optional[dict] = None,
         data: Optional[dict] = None,
         headers: Optional[dict] = None,
+        timeout: Union[float, tuple[float, float], None] = None,
+        hedge: bool = False,
     ):
-        return self.request(
-            "GET", self.get_url(path), params=params, data=data, headers=headers
-        )
+        kwargs = dict(params=params, data=data, headers=headers, timeout=timeout)
+        if hedge and self.hedging:
+            return self.hedged_request("GET", self.get_url(path), **kwargs)
+        return self.request("GET", self.get_url(path), **kwargs)
+
+    def get_hedge_delay(self, window: LatencyWindow) -> float:
+        if len(window) < self.hedge_min_samples:
+            return self.hedge_max_delay
+        delay = window.percentile(self.hedge_percentile)
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    def timed_request(self, window: LatencyWindow, method: str, *args, **kwargs):
+        start_time = time.perf_counter()
+        resp = self.request(method, *args, **kwargs)
+        window.add(time.perf_counter() - start_time)
+        return resp
+
+    def hedged_request(self, method: str, url: str, **kwargs):
+        """
+        Only for idempotent requests that leave no state behind, the slower response
+        is dropped but its cookies would still land in the jar.
+        """
+        with self.lock:
+            window = self.latencies.setdefault(urlparse(url).path, LatencyWindow())
+            if not self.hedge_executor:
+                self.hedge_executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size * 2, thread_name_prefix="Hedge"
+                )
+        executor = self.hedge_executor
+        primary = executor.submit(self.timed_request, window, method, url, **kwargs)
+        done, _ = wait([primary], timeout=self.get_hedge_delay(window))
+        if done:
+            return primary.result()
+
+        hedge = executor.submit(self.timed_request, window, method, url, **kwargs)
+        pending: set[Future] = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    hedged_total.inc(winner="primary" if future is primary else "hedge")
+                    return future.result()
+                error = future.exception()
+        raise error
 
     def get_url(self, path: str):
         if path.startswith("http"):
@@ -49,10 +264,18 @@ class Request(object):
         data: Optional[dict] = None,
         headers: Optional[dict] = None,
         fetch_header: bool = True,
+        json: Optional[dict] = None,
+        timeout: Union[float, tuple[float, float], None] = None,
     ):
         headers = headers if headers else self.session.headers
         if fetch_header:
             headers = dict(headers) | {"X-Requested-With": "Fetch"}
         return self.request(
-            "POST", self.get_url(path), params=params, data=data, headers=headers
+            "POST",
+            self.get_url(path),
+            params=params,
+            data=data,
+            headers=headers,
+            json=json,
+            timeout=timeout,
         )
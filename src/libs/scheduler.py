@@ -0,0 +1,157 @@
+import abc
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds to wait according to the Retry-After header of a failed response"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class PollScheduler(object):
+    """Decide how long a target waits before the next query"""
+
+    def __init__(self, interval: float) -> None:
+        super().__init__()
+        self.interval = interval
+
+    def on_success(self, available: bool):
+        pass
+
+    def on_error(self, error: Exception):
+        pass
+
+    @abc.abstractmethod
+    def next_delay(self) -> float:
+        pass
+
+
+class FixedScheduler(PollScheduler):
+    def next_delay(self) -> float:
+        return self.interval
+
+
+class AdaptiveScheduler(PollScheduler):
+    """
+    Exponential backoff with jitter on errors, Retry-After is respected.
+    When a part becomes available, the faster burst interval is used for a bounded window.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        burst_interval: float = 1,
+        burst_duration: float = 60,
+        max_backoff: float = 300,
+        jitter: float = 0.2,
+    ) -> None:
+        super().__init__(interval)
+        self.burst_interval = min(burst_interval, interval)
+        self.burst_duration = burst_duration
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+        self.errors = 0
+        self.retry_after: Optional[float] = None
+        self.available = False
+        self.burst_until = 0.0
+
+    def on_success(self, available: bool):
+        self.errors = 0
+        self.retry_after = None
+        if available and not self.available:
+            logger.info(f"Stock found, burst mode for {self.burst_duration}s")
+            self.burst_until = time.time() + self.burst_duration
+        self.available = available
+
+    def on_error(self, error: Exception):
+        self.errors += 1
+        self.retry_after = get_retry_after(error)
+
+    def next_delay(self) -> float:
+        if self.errors:
+            backoff = min(self.max_backoff, self.interval * 2 ** (self.errors - 1))
+            # full jitter keeps several targets from retrying in lockstep
+            delay = random.uniform(backoff / 2, backoff)
+            if self.retry_after is not None:
+                delay = max(delay, self.retry_after)
+            return delay
+
+        interval = (
+            self.burst_interval if time.time() < self.burst_until else self.interval
+        )
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class PollBackoff(object):
+    """Poll fast at first and then back off, until the deadline has passed"""
+
+    def __init__(
+        self,
+        timeout: float,
+        initial: float = 0.2,
+        factor: float = 1.5,
+        maximum: float = 2,
+    ) -> None:
+        super().__init__()
+        self.deadline = time.time() + timeout
+        self.delay = initial
+        self.factor = factor
+        self.maximum = maximum
+
+    def wait(self) -> bool:
+        """Sleep before the next poll, False once the deadline has passed"""
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(self.delay, remaining))
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return True
+
+
+class RateLimiter(object):
+    """Token bucket shared by every target, caps the requests per minute"""
+
+    def __init__(
+        self, requests_per_minute: float, burst: Optional[float] = None
+    ) -> None:
+        super().__init__()
+        self.rate = requests_per_minute / 60
+        # a second of requests by default
+        self.capacity = burst or max(self.rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returns how long to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, 0)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
@@ -1,11 +1,23 @@
 import logging
 import argparse
+import atexit
+import json
 import os
 import sys
+import time
 
-from common.schemas import ShopSchema, DeliverySchema, OrderDeliverySchema
+from common.schemas import ShopSchema, OrderDeliverySchema, WishSchema
+from actions.async_inventory_monitoring import AsyncInventoryMonitor
 from actions.inventory_monitoring import InventoryMonitor
+from actions.sharded_monitoring import ShardedInventoryMonitor
 from libs.address import get_address
+from libs.coordination import ClusterCoordinator, SqliteCoordinationStore
+from libs.history import HistoryWriter, get_restock_runs, summarize_runs
+from libs.planner import RestockPlanner
+from libs.metrics import start_metrics_server
+from libs.recorder import ResponseRecorder
+from libs.requests import DnsCache, Request
+from libs.scheduler import RateLimiter
 from libs.notifications import (
     DingTalkNotification,
     NotificationBase,
@@ -32,7 +44,7 @@ def get_notification_providers() -> list[NotificationBase]:
     return providers
 
 
-def get_delivery_data() -> DeliverySchema:
+def get_delivery_data() -> OrderDeliverySchema:
     data = OrderDeliverySchema(
         first_name=os.environ.get("DELIVERY_FIRST_NAME"),
         last_name=os.environ.get("DELIVERY_LAST_NAME"),
@@ -53,6 +65,30 @@ def get_delivery_data() -> DeliverySchema:
     return data
 
 
+def get_targets(path: str, country: str, code: str) -> list[ShopSchema]:
+    with open(path, "r") as f:
+        targets_json = json.load(f)
+    assert isinstance(targets_json, list), "Targets file must contain a list"
+    targets = []
+    for target in targets_json:
+        target.setdefault("country", country)
+        target.setdefault("code", code)
+        assert target["country"] and target.get("models"), "Lack of key information"
+        targets.append(ShopSchema(**target))
+    return targets
+
+
+def get_wishlist(path: str) -> tuple[list[WishSchema], dict[str, OrderDeliverySchema]]:
+    with open(path, "r") as f:
+        wishlist_json = json.load(f)
+    buyers = {
+        name: OrderDeliverySchema(**data)
+        for name, data in wishlist_json["buyers"].items()
+    }
+    wishes = [WishSchema(**i) for i in wishlist_json["wishes"]]
+    return wishes, buyers
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--products", nargs="+", default=[], type=str, help="")
@@ -62,17 +98,102 @@ def get_args():
     parser.add_argument("-lp", "--list-products", action="store_true", help="")
     parser.add_argument("-la", "--list-address", action="store_true", help="")
     parser.add_argument("-lpa", "--list-payments", action="store_true", help="")
+    parser.add_argument(
+        "-lh",
+        "--list-history",
+        action="store_true",
+        help="Restocks in --history-db, filtered by -p and the store names or numbers of -sft",
+    )
     parser.add_argument("-o", "--order", action="store_true", help="")
     parser.add_argument("-onc", "--order-notice-count", type=int, default=1, help="")
     parser.add_argument(
-        "-c", "--country", type=str, required=True, help="cn|hk-zh|sg|jp"
+        "--wishlist", type=str, default="", help="Json file of buyers and wished models"
+    )
+    parser.add_argument(
+        "--order-race-count",
+        type=int,
+        default=1,
+        help="Number of available stores to checkout concurrently, the first to place the order wins",
+    )
+    parser.add_argument(
+        "--order-stage-interval",
+        type=int,
+        default=0,
+        help="Stage order sessions against the filtered stores and refresh the time slots every N seconds, 0 to disable",
     )
+    parser.add_argument("-c", "--country", type=str, default="", help="cn|hk-zh|sg|jp")
     parser.add_argument("--code", type=str, default="", help="15|15-pro")
     parser.add_argument("-i", "--interval", type=int, default=5, help="Query interval")
     parser.add_argument("-ft", "--filter", type=str, default="", help="")
     parser.add_argument(
         "-sft", "--store-filter", nargs="+", type=str, default=[], help=""
     )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=60 * 60 * 24,
+        help="Cache seconds, 0 to disable",
+    )
+    parser.add_argument("--offline", action="store_true", help="Only use the cache")
+    parser.add_argument(
+        "-t", "--targets", type=str, default="", help="Json file of monitoring targets"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve Prometheus metrics on this port",
+    )
+    parser.add_argument(
+        "--dns-cache-ttl", type=int, default=0, help="Cache DNS results for N seconds"
+    )
+    parser.add_argument(
+        "--no-hedge",
+        action="store_true",
+        help="Never duplicate slow inventory queries",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Poll and push on one event loop, requires aiohttp",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Shard the targets across N worker processes",
+    )
+    parser.add_argument(
+        "--history-db",
+        type=str,
+        default="",
+        help="Record the inventory history to this SQLite file",
+    )
+    parser.add_argument(
+        "--history-days", type=int, default=30, help="Days of history to list"
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Query more often at the times the stores restocked before, requires --history-db",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=0,
+        help="Cap of the inventory queries, --plan spends what the intervals would by default",
+    )
+    parser.add_argument(
+        "--cluster-db",
+        type=str,
+        default="",
+        help="SQLite file shared by the nodes of a cluster",
+    )
+    parser.add_argument("--node-id", type=str, default="", help="Default: hostname-pid")
+    parser.add_argument(
+        "--record", type=str, default="", help="Save every response to this directory"
+    )
     parser.add_argument("--ac-type", type=str, default="", help="iphone14|iphone14promax|iphone14plus")
     parser.add_argument("--ac-product", type=str, default="", help="SJTU2CH/A|SJTP2CH/A|SJTW2CH/A|SJTR2CH/A")
     return parser.parse_args()
@@ -80,16 +201,24 @@ def get_args():
 
 def main():
     args = get_args()
+    if args.record:
+        Request.recorder = ResponseRecorder(args.record)
+    if args.no_hedge:
+        Request.hedging = False
+    if args.dns_cache_ttl:
+        DnsCache.install(args.dns_cache_ttl)
 
     if args.list_products:
         assert args.country and args.code, "Lack of key information"
-        products = get_products(args.code, args.country)
+        products = get_products(
+            args.code, args.country, ttl=args.cache_ttl, offline=args.offline
+        )
         for product in products:
             logging.info(product.intro())
         sys.exit(0)
     if args.list_address:
         assert args.country, "Lack of key information"
-        addresses = get_address(args.country, args.filter)
+        addresses = get_address(args.country, args.filter, offline=args.offline)
         for address in addresses:
             logging.info(address)
         sys.exit(0)
@@ -99,21 +228,80 @@ def main():
         for payment in payments:
             logging.info(payment.intro())
         sys.exit(0)
+    if args.list_history:
+        assert args.history_db and os.path.exists(
+            args.history_db
+        ), "Lack of history database"
+        runs = get_restock_runs(
+            args.history_db,
+            stores=args.store_filter,
+            models=args.products,
+            since=time.time() - args.history_days * 24 * 60 * 60,
+        )
+        for run in runs:
+            logging.info(run.intro())
+        for summary in summarize_runs(runs):
+            logging.info(summary.intro())
+        sys.exit(0)
+    if args.targets:
+        shop_data = get_targets(args.targets, args.country, args.code)
+    else:
+        assert args.country, "Lack of key information"
+        shop_data = ShopSchema(
+            args.country,
+            models=args.products,
+            location=args.location,
+            postal_code=args.postal_code,
+            state=args.state,
+            code=args.code,
+            store_filters=args.store_filter,
+        )
     delivery_data = None
-    if args.order:
+    wishes, buyers = None, None
+    if args.order and args.wishlist:
+        wishes, buyers = get_wishlist(args.wishlist)
+    elif args.order:
         delivery_data = get_delivery_data()
-        assert args.code, "Lack of key information"
-
-    shop_data = ShopSchema(
-        args.country,
-        models=args.products,
-        location=args.location,
-        postal_code=args.postal_code,
-        state=args.state,
-        code=args.code,
-        store_filters=args.store_filter
-    )
-    InventoryMonitor().start(
+        first_target = shop_data[0] if isinstance(shop_data, list) else shop_data
+        assert first_target.code, "Lack of key information"
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    history = HistoryWriter(args.history_db) if args.history_db else None
+    planner = None
+    if args.plan:
+        assert args.history_db, "--plan learns from --history-db"
+        planner = RestockPlanner(
+            args.history_db, requests_per_minute=args.requests_per_minute
+        )
+    rate_limiter = (
+        RateLimiter(args.requests_per_minute) if args.requests_per_minute else None
+    )
+    cluster = None
+    if args.cluster_db:
+        cluster = ClusterCoordinator(
+            SqliteCoordinationStore(args.cluster_db), node_id=args.node_id
+        )
+        cluster.start()
+        atexit.register(cluster.stop)
+    if args.workers:
+        assert not args.use_async, "--async is not supported with --workers"
+        monitor = ShardedInventoryMonitor(
+            workers=args.workers,
+            metrics_port=args.metrics_port,
+            cluster=cluster,
+            history=history,
+            planner=planner,
+            rate_limiter=rate_limiter,
+        )
+    elif args.use_async:
+        monitor = AsyncInventoryMonitor(
+            cluster=cluster, history=history, planner=planner, rate_limiter=rate_limiter
+        )
+    else:
+        monitor = InventoryMonitor(
+            cluster=cluster, history=history, planner=planner, rate_limiter=rate_limiter
+        )
+    monitor.start(
         shop_data,
         order=args.order,
         delivery_data=delivery_data,
@@ -121,7 +309,11 @@ def main():
         interval=args.interval,
         order_notice_count=args.order_notice_count,
         ac_model=args.ac_product,
-        ac_type=args.ac_type
+        ac_type=args.ac_type,
+        order_stage_interval=args.order_stage_interval,
+        order_race_count=args.order_race_count,
+        wishes=wishes,
+        buyers=buyers,
     )
 
 
@@ -0,0 +1,95 @@
+import asyncio
+import unittest
+
+from actions.checkout import CheckoutStateMachine
+from actions.order import OrderRace
+from common.schemas import OrderDeliverySchema, OrderSchema
+
+
+class FakeOrder(object):
+    """Order whose process_order fails the given number of times"""
+
+    def __init__(self, process_failures: int) -> None:
+        super().__init__()
+        self.process_failures = process_failures
+        self.calls: list[str] = []
+
+    def select_window(self, order_data):
+        return {"window": 1}
+
+    def fill_contact(self, *args):
+        self.calls.append("fill_contact")
+
+    def fill_recipient(self, *args):
+        self.calls.append("fill_recipient")
+
+    def fill_pay_method(self, *args):
+        self.calls.append("fill_pay_method")
+
+    def get_place_order_data(self, timeout=30):
+        self.calls.append("place_order")
+        return {"head": {}}
+
+    def process_order(self, place_order_data, timeout=60):
+        self.calls.append("process_order")
+        if self.process_failures:
+            self.process_failures -= 1
+            raise TimeoutError("Order status is not ready")
+
+    def get_order_number(self, place_order_data, timeout=120):
+        self.calls.append("confirm_order")
+        return "W123"
+
+
+order_data = OrderSchema(
+    model="MTQ83CH/A",
+    model_code="iphone-15-pro",
+    country="cn",
+    store_number="R388",
+    delivery=OrderDeliverySchema("a", "b", "c", "d", "e", "alipay"),
+)
+
+
+class CheckoutStateMachineTest(unittest.TestCase):
+    def test_resume_after_place_order(self):
+        order = FakeOrder(process_failures=1)
+        checkout = CheckoutStateMachine(order, order_data)
+        self.assertTrue(checkout.run())
+        self.assertEqual(order.calls.count("place_order"), 1)
+        self.assertEqual(order.calls.count("process_order"), 2)
+        self.assertEqual(checkout.order_number, "W123")
+
+    def test_placed_order_is_never_failed(self):
+        order = FakeOrder(process_failures=10)
+        checkout = CheckoutStateMachine(order, order_data, max_resumes=2)
+        self.assertTrue(checkout.run())
+        self.assertEqual(order.calls.count("place_order"), 1)
+        self.assertEqual(order.calls.count("process_order"), 3)
+        self.assertEqual(checkout.order_number, "")
+
+    def test_placed_order_is_never_failed_async(self):
+        order = FakeOrder(process_failures=10)
+        checkout = CheckoutStateMachine(order, order_data)
+        self.assertTrue(asyncio.run(checkout.run_async()))
+        self.assertEqual(order.calls.count("place_order"), 1)
+
+    def test_failure_before_place_order_raises(self):
+        order = FakeOrder(process_failures=0)
+        order.fill_recipient = lambda *args: 1 / 0
+        checkout = CheckoutStateMachine(order, order_data)
+        with self.assertRaises(ZeroDivisionError):
+            checkout.run()
+        self.assertNotIn("place_order", order.calls)
+
+    def test_lease_renewed_before_every_step(self):
+        renewals = []
+        race = OrderRace(renew=lambda: renewals.append(1) or True)
+        order = FakeOrder(process_failures=0)
+        self.assertTrue(CheckoutStateMachine(order, order_data, race=race).run())
+        self.assertEqual(len(renewals), len(CheckoutStateMachine.steps))
+
+    def test_lost_lease_gives_up_before_place_order(self):
+        race = OrderRace(renew=lambda: False)
+        order = FakeOrder(process_failures=0)
+        self.assertIsNone(CheckoutStateMachine(order, order_data, race=race).run())
+        self.assertNotIn("place_order", order.calls)
@@ -0,0 +1,69 @@
+import time
+import unittest
+
+from actions.order import OrderSessionPool, PoolData
+from actions.order_dispatcher import OrderDispatcher
+from common.schemas import (
+    DeliverySchema,
+    InventoryEventSchema,
+    OrderDeliverySchema,
+    WishSchema,
+)
+
+
+class FakeOrder(object):
+    """Order whose checkout only takes part in the race"""
+
+    def start_order(self, order_data, race=None):
+        time.sleep(0.05)
+        return True if race.claim(order_data.store_number) else None
+
+
+class FakeSessionPool(OrderSessionPool):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.created: list[FakeOrder] = []
+
+    def new(self, order_data, max_retries: int = 5):
+        order = FakeOrder()
+        self.created.append(order)
+        return PoolData(order=order, timestamp=time.time(), warmed_at=time.time())
+
+    def wait_ready(self, timeout: float = 5) -> bool:
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: len(self.pools) == self.size and not self.creating,
+                timeout=timeout,
+            )
+
+
+def get_event(store_number: str) -> InventoryEventSchema:
+    delivery = DeliverySchema(
+        "state", "city", "district", "Apple", store_number, "m", "Today", "A1", "", ""
+    )
+    return InventoryEventSchema("available", delivery)
+
+
+class OrderRaceTest(unittest.TestCase):
+    def setUp(self):
+        wish = WishSchema(model="A1", model_code="iphone", buyer="default")
+        buyer = OrderDeliverySchema("a", "b", "c", "d", "e", "alipay")
+        self.dispatcher = OrderDispatcher("cn", [wish], {"default": buyer}, 2)
+        self.pool = FakeSessionPool(size=3)
+        self.dispatcher.pools[("A1", "default")] = self.pool
+        self.pool.start(self.dispatcher.get_order_data(wish))
+        self.assertTrue(self.pool.wait_ready())
+        self.wish = wish
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_race_losers_go_back_to_the_pool(self):
+        initial = list(self.pool.created)
+        won = self.dispatcher.race_orders(self.wish, [get_event("R1"), get_event("R2")])
+        self.assertTrue(won)
+        self.assertTrue(self.pool.wait_ready())
+        # only the winner's session is consumed and replaced
+        self.assertEqual(len(self.pool.created), len(initial) + 1)
+        self.assertEqual(len([i for i in self.pool.pools if i.order in initial]), 2)
+        self.assertFalse(any(i.busy for i in self.pool.pools))